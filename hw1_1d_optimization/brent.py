@@ -3,6 +3,14 @@
 import numpy as np
 
 
+# вершина параболы через (x1, f1), (x2, f2), (x3, f3) в явном виде, без
+# решения системы 3 x 3; работает и для массивов
+def vertex(x1, x2, x3, f1, f2, f3):
+    p = (x2 - x1) ** 2 * (f2 - f3) - (x2 - x3) ** 2 * (f2 - f1)
+    q = (x2 - x1) * (f2 - f3) - (x2 - x3) * (f2 - f1)
+    return x2 - p / (2 * q)
+
+
 def optimize(a, b, f, eps=1e-8, stat=False):
     K = (3 - 5**0.5) / 2
     
@@ -40,15 +48,8 @@ def optimize(a, b, f, eps=1e-8, stat=False):
         # пробуем применить метод парабол
         if x1 != x2 and x1 != x3 and x2 != x3: 
             if f_x1 < f_x2 and f_x1 < f_x3: 
-                A = np.array([[x1 ** 2, x1, 1], 
-                              [x2 ** 2, x2, 1], 
-                              [x3 ** 2, x3, 1]])
-                B = np.array([f_x1, f_x2, f_x3])
-                
-                # коэффициенты аппроксимирующего многочлена 
-                a2, a1, a0 = np.linalg.solve(A, B)
-                # точка минимума многочлена
-                x_new = - a1 / (2 * a2) 
+                # точка минимума аппроксимирующего многочлена
+                x_new = vertex(x1, x2, x3, f_x1, f_x2, f_x3)
                 
                 # принимать ли найденную точку x_new
                 if  (a <= x_new <= b) and abs(x_new - x1) < I_preprev / 2:
@@ -104,4 +105,74 @@ def optimize(a, b, f, eps=1e-8, stat=False):
     f_min = f_x_new
     if stat:
         return x_min, f_min, iter_nums, accuracy
-    return np.array(x_min)
\ No newline at end of file
+    return np.array(x_min)
+
+
+# много независимых задач сразу (см. mzs.optimize_batch): на каждой итерации
+# для каждой задачи выбирается шаг парабол или МЗС, f вызывается один раз
+# для всех; возвращается лучшая найденная точка x1
+def optimize_batch(a, b, f, eps=1e-8, stat=False, max_iter=500):
+    K = (3 - 5**0.5) / 2
+    a = np.array(a, dtype=np.float64)
+    b = np.array(b, dtype=np.float64)
+
+    x1 = a + K * (b - a)
+    x2, x3 = x1, x1
+    f_x1, _ = f(x1)
+    f_x2, f_x3 = f_x1, f_x1
+
+    I_curr = b - a
+    I_prev = b - a
+    cnt = np.zeros(a.shape, dtype=int)
+    active = I_curr > eps
+
+    while active.any() and cnt.max() < max_iter:
+        I_preprev = I_prev
+        I_prev = np.where(active, I_curr, I_prev)
+
+        tol = eps * np.abs(x1) + eps / 10
+        m = (a + b) / 2
+        # критерий остановки
+        active &= np.abs(x1 - m) + (b - a) / 2 > 2 * tol
+        if not active.any():
+            break
+        cnt += active
+
+        # шаг метода парабол там, где он допустим
+        with np.errstate(divide="ignore", invalid="ignore"):
+            u = vertex(x1, x2, x3, f_x1, f_x2, f_x3)
+        parabola = ((x1 != x2) & (x1 != x3) & (x2 != x3) & (f_x1 < f_x2) & (f_x1 < f_x3)
+                    & np.isfinite(u) & (a <= u) & (u <= b) & (np.abs(u - x1) < I_preprev / 2))
+        edge = parabola & (((u - a) < 2 * tol) | ((b - u) < 2 * tol))
+        u = np.where(edge, x1 - np.sign(x1 - m) * tol, u)
+
+        # иначе - шаг МЗС
+        lower = x1 < m
+        golden = np.where(lower, x1 + K * (b - x1), x1 - K * (x1 - a))
+        I_prev = np.where(active & ~parabola, np.where(lower, b - x1, x1 - a), I_prev)
+
+        x_new = np.where(active, np.where(parabola, u, golden), x1)
+        I_curr = np.where(active, np.abs(x_new - x1), I_curr)
+        f_new, _ = f(x_new)
+
+        better = active & (f_new <= f_x1)
+        worse = active & ~better
+        right = x_new >= x1
+        a = np.where(better & right, x1, np.where(worse & ~right, x_new, a))
+        b = np.where(better & ~right, x1, np.where(worse & right, x_new, b))
+
+        # сдвиг 3-х лучших
+        c2 = worse & ((f_new <= f_x2) | (x2 == x1))
+        c3 = worse & ~c2 & ((f_new <= f_x3) | (x3 == x1) | (x3 == x2))
+        x3 = np.where(better | c2, x2, np.where(c3, x_new, x3))
+        f_x3 = np.where(better | c2, f_x2, np.where(c3, f_new, f_x3))
+        x2 = np.where(better, x1, np.where(c2, x_new, x2))
+        f_x2 = np.where(better, f_x1, np.where(c2, f_new, f_x2))
+        x1 = np.where(better, x_new, x1)
+        f_x1 = np.where(better, f_new, f_x1)
+
+        active &= I_curr > eps
+
+    if stat:
+        return x1, f_x1, cnt
+    return x1
@@ -48,4 +48,47 @@ def optimize(a, b, f, eps=1e-8, stat=False):
     if stat:
         return x_min, f_min, iter_nums, accuracy
     else:
-        return np.array(x_min)
\ No newline at end of file
+        return np.array(x_min)
+
+
+# много независимых задач сразу: a, b - массивы концов отрезков,
+# f(x) принимает массив точек и возвращает (массив значений, _);
+# на каждой итерации f вызывается один раз для всех задач,
+# сошедшиеся задачи (маска active) больше не меняются
+def optimize_batch(a, b, f, eps=1e-8, stat=False, max_iter=None):
+    K = (5**0.5 - 1) / 2
+    a = np.array(a, dtype=np.float64)
+    b = np.array(b, dtype=np.float64)
+    I = K * (b - a)
+
+    x = b - I
+    y = a + I
+    f_x, _ = f(x)
+    f_y, _ = f(y)
+    cnt = np.zeros(a.shape, dtype=int)
+    active = I >= eps
+
+    while active.any():
+        if max_iter is not None and cnt.max() >= max_iter:
+            break
+        cnt += active
+        I = np.where(active, I * K, I)
+
+        right = active & (f_x >= f_y)     # берём правый отрезок
+        left = active & ~right            # берём левый отрезок
+        a = np.where(right, x, a)
+        b = np.where(left, y, b)
+        x, y = np.where(right, y, np.where(left, b - I, x)), np.where(right, a + I, np.where(left, x, y))
+        f_x, f_y = np.where(right, f_y, f_x), np.where(left, f_x, f_y)
+
+        # новая точка: y для правых, x для левых (у остальных - x, результат не нужен)
+        f_new, _ = f(np.where(right, y, x))
+        f_x = np.where(left, f_new, f_x)
+        f_y = np.where(right, f_new, f_y)
+        active &= I >= eps
+
+    x_min = np.where(f_x <= f_y, x, y)
+    f_min = np.minimum(f_x, f_y)
+    if stat:
+        return x_min, f_min, cnt
+    return x_min
@@ -3,6 +3,14 @@
 import numpy as np
 
 
+# вершина параболы через (x1, f1), (x2, f2), (x3, f3) в явном виде, без
+# решения системы 3 x 3; работает и для массивов
+def vertex(x1, x2, x3, f1, f2, f3):
+    p = (x2 - x1) ** 2 * (f2 - f3) - (x2 - x3) ** 2 * (f2 - f1)
+    q = (x2 - x1) * (f2 - f3) - (x2 - x3) * (f2 - f1)
+    return x2 - p / (2 * q)
+
+
 def optimize(a, b, f, eps=1e-8, stat=False):
     #I = b - a    
     f_a, _ = f(a) 
@@ -23,13 +31,7 @@ def optimize(a, b, f, eps=1e-8, stat=False):
     while I >= eps:
         cnt += 1
         x_prev = x_new
-        A = np.array([[x1 ** 2, x1, 1], 
-                      [x2 ** 2, x2, 1], 
-                      [x3 ** 2, x3, 1]])
-        B = np.array([f_x1, f_x2, f_x3])
-        
-        a2, a1, a0 = np.linalg.solve(A, B)
-        x_new = - a1 / (2 * a2) 
+        x_new = vertex(x1, x2, x3, f_x1, f_x2, f_x3)
         f_new, _ = f(x_new)
 
         if f_x2 <= f_new:
@@ -51,4 +53,44 @@ def optimize(a, b, f, eps=1e-8, stat=False):
     f_min = f_new
     if stat:
         return x_min, f_min, iter_nums, accuracy
-    return np.array(x_min)
\ No newline at end of file
+    return np.array(x_min)
+
+
+# много независимых задач сразу (см. mzs.optimize_batch): f вызывается один
+# раз за итерацию для всех задач, сошедшиеся и вырожденные (три точки на
+# одной прямой) задачи маскируются
+def optimize_batch(a, b, f, eps=1e-8, stat=False, max_iter=100):
+    a = np.array(a, dtype=np.float64)
+    b = np.array(b, dtype=np.float64)
+    f_a, _ = f(a)
+    f_b, _ = f(b)
+    x1, x2, x3 = a, (a + b) / 2, b
+    f_x1 = f_a
+    f_x2, _ = f(x2)
+    f_x3 = f_b
+
+    x_new, f_new = x2, f_x2
+    cnt = np.zeros(a.shape, dtype=int)
+    active = np.ones(a.shape, dtype=bool)
+
+    while active.any() and cnt.max() < max_iter:
+        cnt += active
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_vertex = vertex(x1, x2, x3, f_x1, f_x2, f_x3)
+        active &= np.isfinite(x_vertex)
+        x_prev = x_new
+        x_new = np.where(active, x_vertex, x_new)
+        f_vertex, _ = f(x_new)
+        f_new = np.where(active, f_vertex, f_new)
+
+        right = active & (f_x2 <= f_new)
+        left = active & ~right
+        x3, f_x3 = np.where(right, x_new, x3), np.where(right, f_new, f_x3)
+        x1, f_x1 = np.where(left, x2, x1), np.where(left, f_x2, f_x1)
+        x2, f_x2 = np.where(left, x_new, x2), np.where(left, f_new, f_x2)
+
+        active &= np.abs(x_prev - x_new) >= eps
+
+    if stat:
+        return x_new, f_new, cnt
+    return x_new
@@ -5,44 +5,155 @@ from scipy.optimize import line_search as wolf
 from scipy.optimize import brent
 from mzs import optimize as mzs
 
-class line_search_golden:
-    def __init__(self, a=0, b=15, eps=1e-5):
+
+class StepMemory:
+    # память шага между вызовами line search:
+    # warm=None - каждый вызов с нуля (alpha = 1, отрезок [a, b]);
+    # "prev" - старт с прошлого принятого шага;
+    # "ratio" - прошлый шаг, умноженный на phi'_{k-1}(0) / phi'_k(0);
+    # "bb" - шаг Барзилаи-Борвейна по прошлым точке и градиенту
+    # (градиент в w - ещё один вызов оракула)
+    def __init__(self, warm=None):
+        self.warm = warm
+        self.reset()
+
+    # сброс памяти (новая задача, рестарт метода) и статистики
+    def reset(self):
+        self.alpha = None
+        self.dphi0 = None
+        self.w = None
+        self.g = None
+        self._g = None
+        # начальный шаг, число вычислений phi и сколько вычислений
+        # сэкономлено относительно холодного старта - только у поисков,
+        # которые могут посчитать холодный старт без его запуска (Армихо),
+        # у остальных список пуст
+        self.starts = []
+        self.evals = []
+        self.saved = []
+
+    def start(self, line, default, dphi0):
+        calls = 0
+        if self.warm == "bb":
+            self._g = line.oracle.grad(line.w)
+            calls += 1
+        if self.warm is None or self.alpha is None:
+            return default, calls
+        alpha = self.alpha
+        if self.warm == "ratio":
+            dphi0 = np.asarray(dphi0).item()
+            if dphi0 == 0 or self.dphi0 == 0:
+                return default, calls
+            alpha = self.alpha * self.dphi0 / dphi0
+        elif self.warm == "bb" and self.g is not None and self.g.shape == self._g.shape:
+            s = line.w - self.w
+            y = self._g - self.g
+            sy = np.sum(s * y)
+            if sy > 0:
+                # минимум модели с гессианом (s.T y / s.T s) I вдоль direction
+                alpha = - np.asarray(dphi0).item() * np.sum(s * s) / (sy * np.sum(line.d * line.d))
+        return alpha, calls
+
+    def record(self, line, alpha0, alpha, dphi0, evals, cold_evals=None):
+        self.alpha = np.asarray(alpha).item()
+        self.dphi0 = np.asarray(dphi0).item()
+        if self.warm == "bb":
+            self.w = line.w
+            self.g = self._g
+        self.starts.append(alpha0)
+        self.evals.append(evals)
+        if cold_evals is not None:
+            self.saved.append(cold_evals - evals)
+
+class line_search_golden(StepMemory):
+    # adaptive=True: отрезок с минимумом ищется от alpha0 (прошлого принятого
+    # шага) расширением или сжатием в grow раз, затем уточняется золотым
+    # сечением (refine="golden") или Брентом (refine="brent") до
+    # относительной точности rtol;
+    # adaptive=False - золотое сечение на фиксированном [a, b]
+    def __init__(self, a=0, b=15, eps=1e-5, warm="prev", adaptive=True, rtol=1e-4,
+                 refine="golden", grow=2.):
         self.a = a
         self.b = b
         self.eps = eps
+        self.adaptive = adaptive
+        self.rtol = rtol
+        self.refine = refine
+        self.grow = grow
+        super().__init__(warm)
         
     def __call__(self, f, w, direction, stata=False):
-        F = lambda x: f.fuse_value_grad(w + x * direction)
-        alpha, funcalls = mzs(self.a, self.b, F, self.eps)
+        line = f.line(w, direction)
+        F = lambda x: (line.value(x), None)
+        phi0, dphi0 = line.fuse_value_grad(0)
+        if not self.adaptive:
+            alpha0 = self.b
+            alpha, funcalls = mzs(self.a, self.b, F, self.eps)
+        else:
+            alpha0, calls = self.start(line, 1., dphi0)
+            phi = lambda x: line.value(x).item()
+            (a, b, c), funcalls = bracket_minimum(phi, phi0.item(), alpha0, self.grow)
+            funcalls += calls
+            alpha = None
+            if self.refine == "brent":
+                try:
+                    alpha, _, _, calls = brent(phi, brack=(a, b, c), tol=self.rtol, full_output=True)
+                    funcalls += calls
+                except ValueError:
+                    # phi(b) == phi(c): Брент требует строгой скобки
+                    pass
+            if alpha is None:
+                alpha, calls = mzs(a, c, F, 0., max_iter=None, rtol=self.rtol)
+                funcalls += calls
+        line.accept(alpha)
+        self.record(line, alpha0, alpha, dphi0, funcalls)
         if stata:
             return alpha, funcalls
         return alpha
 
-class line_search_brent:
-    def __init__(self):
-        pass
+class line_search_brent(StepMemory):
+    def __init__(self, warm=None):
+        super().__init__(warm)
         
     def __call__(self, f, w, direction, stata=False):
-        F = lambda x: f.value(w + x * direction)
-        alpha, _, _, funcalls = brent(F, full_output=True)
+        line = f.line(w, direction)
+        # поиск отрезка начинается с (0, alpha0), по умолчанию (0, 1)
+        dphi0 = line.grad(0)
+        alpha0, calls = self.start(line, 1., dphi0)
+        alpha, _, _, funcalls = brent(line.value, brack=(0., alpha0), full_output=True)
+        funcalls += calls
+        line.accept(alpha)
+        self.record(line, alpha0, alpha, dphi0, funcalls)
         if stata:
             return np.array(alpha), funcalls
         return np.array(alpha)
 
-class line_search_wolf:
-    def __init__(self, c1=0.0001, c2=0.9):
+class line_search_wolf(StepMemory):
+    def __init__(self, c1=0.0001, c2=0.9, warm=None):
         self.c1 = c1
         self.c2 = c2
+        super().__init__(warm)
         
     def __call__(self, f, w, direction, stata=False):
-        F = f.value
-        gr_F = lambda x: f.grad(x).reshape(-1)
-        alpha, fc, gc, _, _, _ = wolf(F, gr_F, w, direction, c1=self.c1, c2=self.c2)
-        funcalls = max(fc, gc)
+        # одномерная задача phi(0 + a * 1) вместо f(w + a * direction)
+        line = f.line(w, direction)
+        F = lambda a: line.value(a[0]).item()
+        gr_F = lambda a: line.grad(a[0]).reshape(-1)
+        phi0, dphi0 = line.fuse_value_grad(0)
+        alpha0, calls = self.start(line, 1., dphi0)
+        # scipy начинает с единичного шага вдоль pk, поэтому pk = alpha0
+        alpha, fc, gc, _, _, _ = wolf(F, gr_F, np.zeros(1), np.full(1, alpha0), c1=self.c1,
+                                      c2=self.c2, old_fval=phi0.item())
+        funcalls = max(fc, gc) + calls
+        if alpha is not None:
+            alpha = alpha * alpha0
         
         if alpha is None:
             armijo = line_search_armijo()
             alpha, funcalls = armijo(f, w, direction, stata=True)
+        else:
+            line.accept(alpha)
+        self.record(line, alpha0, alpha, dphi0, funcalls)
             
         if stata:
             return np.array(alpha), funcalls
@@ -51,10 +162,15 @@ class line_search_wolf:
 class line_search_nesterov:
     def __init__(self, L=1):
         self.L = 1
+
+    # память этого поиска - оценка L
+    def reset(self):
+        self.L = 1
         
     def __call__(self, f, w, direction, stata=False):
-        phi = lambda a: f.value(w + a * direction)
-        dphi = lambda a: direction.T @ f.grad(w + a * direction)
+        line = f.line(w, direction)
+        phi = line.value
+        dphi = line.grad
         
         funcalls = 0      
         phi0 = phi(0)
@@ -68,20 +184,23 @@ class line_search_nesterov:
             funcalls += 1            
         alpha = 1 / self.L
         self.L /= 2   
+        line.accept(alpha)
         
         if stata:
             return np.array(alpha), funcalls
         return np.array(alpha)
 
     
-class line_search_armijo:
-    def __init__(self, c1=0.4, eta=2):
+class line_search_armijo(StepMemory):
+    def __init__(self, c1=0.4, eta=2, warm=None):
         self.c1 = c1
         self.eta = eta
+        super().__init__(warm)
         
     def __call__(self, f, w, direction, stata=False):        
-        phi = lambda a: f.value(w + a * direction)
-        dphi = lambda a: direction.T @ f.grad(w + a * direction)
+        line = f.line(w, direction)
+        phi = line.value
+        dphi = line.grad
         
         funcalls = 0      
         phi0 = phi(0)
@@ -89,7 +208,10 @@ class line_search_armijo:
         funcalls += 1
         
         iter_num = 0
-        alpha = 1
+        alpha0, calls = self.start(line, 1., dphi0)
+        funcalls += calls
+        evals0 = funcalls
+        alpha = alpha0
         first_cond = phi(alpha) <= phi0 + self.c1 * alpha * dphi0
         second_cond = phi(self.eta * alpha) >= phi0 + self.c1 * self.eta * alpha * dphi0
         funcalls += 2
@@ -103,7 +225,11 @@ class line_search_armijo:
                 alpha = self.eta * alpha
                 second_cond = phi(self.eta * alpha) >= phi0 + self.c1 * self.eta * alpha * dphi0
                 funcalls += 1
-            return np.array(alpha), funcalls
+            line.accept(alpha)
+            self._record_armijo(line, alpha0, alpha, dphi0, funcalls - evals0)
+            if stata:
+                return np.array(alpha), funcalls
+            return np.array(alpha)
 
         if second_cond:
             # while second_cond and not first_cond:
@@ -114,8 +240,290 @@ class line_search_armijo:
                 alpha = alpha / self.eta
                 first_cond = phi(alpha) <= phi0 + self.c1 * alpha * dphi0
                 funcalls += 1
+        line.accept(alpha)
+        self._record_armijo(line, alpha0, alpha, dphi0, funcalls - evals0)
                 
         if stata:
             return np.array(alpha), funcalls
         return np.array(alpha)
 
+    # холодный старт с alpha = 1: две проверки и по одной на каждый
+    # множитель eta между 1 и alpha
+    def _record_armijo(self, line, alpha0, alpha, dphi0, evals):
+        cold = 2 + abs(round(np.log(alpha) / np.log(self.eta)))
+        self.record(line, alpha0, alpha, dphi0, evals, cold)
+
+
+class line_search_ladder(StepMemory):
+    # Армихо по лестнице шагов alpha_max, alpha_max / eta, ..., size штук:
+    # phi (и phi' при c2) во всех точках лестницы - один векторный проход
+    # по отступам X @ w + a X @ d, берётся наибольший шаг с достаточным
+    # убыванием; если не подошёл ни один - лестница сдвигается вниз,
+    # если подошёл самый большой - вверх
+    def __init__(self, c1=0.4, eta=2., size=12, c2=None, max_passes=10, warm=None):
+        self.c1 = c1
+        self.eta = eta
+        self.size = size
+        self.c2 = c2
+        self.max_passes = max_passes
+        super().__init__(warm)
+
+    def __call__(self, f, w, direction, stata=False, with_value=False):
+        line = f.line(w, direction)
+        phi0, dphi0 = line.fuse_value_grad(0)
+        funcalls = 1
+
+        # лестница с центром в alpha0 (по умолчанию 1)
+        alpha0, calls = self.start(line, 1., dphi0)
+        funcalls += calls
+        ladder = self.eta ** -np.arange(self.size, dtype=np.float64)
+        top = alpha0 * self.eta ** (self.size // 2)
+        alpha, phi_alpha = None, None
+        for _ in range(self.max_passes):
+            alphas = top * ladder
+            if self.c2 is None:
+                phi = line.values(alphas)
+                ok = phi <= phi0 + self.c1 * alphas * dphi0
+            else:
+                phi, dphi = line.values(alphas, grad=True)
+                ok = phi <= phi0 + self.c1 * alphas * dphi0
+                # кривизна - только если её выполняет хотя бы один шаг
+                curv = ok & (dphi >= self.c2 * dphi0)
+                if curv.any():
+                    ok = curv
+            funcalls += 1
+            ok = ok.reshape(-1)
+            if ok.any():
+                k = np.argmax(ok)
+                alpha, phi_alpha = alphas[k], phi.reshape(-1)[k]
+                if k > 0 or alpha > 1e10:
+                    break
+                top *= self.eta ** self.size
+            elif alpha is not None:
+                break
+            else:
+                top = alphas[-1] / self.eta
+        if alpha is None:
+            alpha, phi_alpha = alphas[-1], phi.reshape(-1)[-1]
+        line.accept(alpha)
+        self.record(line, alpha0, alpha, dphi0, funcalls)
+
+        result = (np.array(alpha),)
+        if stata:
+            result += (funcalls,)
+        if with_value:
+            result += (phi_alpha,)
+        return result if len(result) > 1 else result[0]
+
+
+class line_search_more_thuente(StepMemory):
+    # сильные условия Вольфе без scipy: phi и phi' в пробной точке - одно
+    # вычисление отступов; full_output=True возвращает ещё значение и
+    # градиент f в принятой точке, оптимизатору не нужен лишний вызов оракула
+    returns_value_grad = True
+
+    def __init__(self, c1=1e-4, c2=0.9, xtol=1e-10, alpha_max=1e10, max_evals=20, warm=None):
+        self.c1 = c1
+        self.c2 = c2
+        self.xtol = xtol
+        self.alpha_max = alpha_max
+        self.max_evals = max_evals
+        super().__init__(warm)
+
+    def __call__(self, f, w, direction, stata=False, full_output=False):
+        line = f.line(w, direction)
+        phi0, dphi0 = line.fuse_value_grad(0)
+        funcalls = 1
+
+        if dphi0.item() >= 0:
+            # не направление спуска
+            armijo = line_search_armijo()
+            alpha, funcalls = armijo(f, w, direction, stata=True)
+        else:
+            alpha0, calls = self.start(line, 1., dphi0)
+            funcalls += calls
+            phi_dphi = lambda a: tuple(v.item() for v in line.fuse_value_grad(a))
+            alpha, _, _, evals = more_thuente(phi_dphi, phi0.item(), dphi0.item(), min(alpha0, self.alpha_max),
+                                              ftol=self.c1, gtol=self.c2, xtol=self.xtol,
+                                              stpmax=self.alpha_max, max_evals=self.max_evals)
+            funcalls += evals
+            self.record(line, alpha0, alpha, dphi0, funcalls)
+        alpha = np.array(alpha)
+
+        if not full_output:
+            line.accept(alpha)
+            if stata:
+                return alpha, funcalls
+            return alpha
+        _, value, grad = line.fuse_accept(alpha)
+        if stata:
+            return alpha, funcalls, value, grad
+        return alpha, value, grad
+
+
+# тройка a < b < c с phi(b) < phi(a), phi(b) <= phi(c): пока phi убывает, шаг
+# растёт в grow раз, если phi(alpha0) >= phi(0) - уменьшается; число
+# вычислений O(log(alpha* / alpha0))
+def bracket_minimum(phi, phi0, alpha0, grow=2., alpha_min=1e-12, alpha_max=1e10):
+    b = alpha0
+    fb = phi(b)
+    calls = 1
+    if fb < phi0:
+        a = 0.
+        while True:
+            c = b * grow
+            fc = phi(c)
+            calls += 1
+            if fc >= fb or c >= alpha_max:
+                return (a, b, c), calls
+            a, b, fb = b, c, fc
+    c = b
+    while True:
+        b = c / grow
+        fb = phi(b)
+        calls += 1
+        if fb < phi0 or b <= alpha_min:
+            return (0., b, c), calls
+        c = b
+
+
+# шаг Море-Туэнте (dcstep из MINPACK-2): новый пробный шаг по кубической
+# или квадратичной интерполяции и обновление отрезка [stx, sty]
+def _dcstep(stx, fx, dx, sty, fy, dy, stp, fp, dp, brackt, stpmin, stpmax):
+    sgnd = dp * np.sign(dx)
+    if fp > fx:
+        theta = 3 * (fx - fp) / (stp - stx) + dx + dp
+        s = max(abs(theta), abs(dx), abs(dp))
+        gamma = s * np.sqrt(max(0., (theta / s) ** 2 - (dx / s) * (dp / s)))
+        if stp < stx:
+            gamma = -gamma
+        p = (gamma - dx) + theta
+        q = ((gamma - dx) + gamma) + dp
+        stpc = stx + p / q * (stp - stx)
+        stpq = stx + dx / ((fx - fp) / (stp - stx) + dx) / 2 * (stp - stx)
+        if abs(stpc - stx) < abs(stpq - stx):
+            stpf = stpc
+        else:
+            stpf = stpc + (stpq - stpc) / 2
+        brackt = True
+    elif sgnd < 0:
+        theta = 3 * (fx - fp) / (stp - stx) + dx + dp
+        s = max(abs(theta), abs(dx), abs(dp))
+        gamma = s * np.sqrt(max(0., (theta / s) ** 2 - (dx / s) * (dp / s)))
+        if stp > stx:
+            gamma = -gamma
+        p = (gamma - dp) + theta
+        q = ((gamma - dp) + gamma) + dx
+        stpc = stp + p / q * (stx - stp)
+        stpq = stp + dp / (dp - dx) * (stx - stp)
+        stpf = stpc if abs(stpc - stp) > abs(stpq - stp) else stpq
+        brackt = True
+    elif abs(dp) < abs(dx):
+        theta = 3 * (fx - fp) / (stp - stx) + dx + dp
+        s = max(abs(theta), abs(dx), abs(dp))
+        gamma = s * np.sqrt(max(0., (theta / s) ** 2 - (dx / s) * (dp / s)))
+        if stp > stx:
+            gamma = -gamma
+        p = (gamma - dp) + theta
+        q = (gamma + (dx - dp)) + gamma
+        r = p / q
+        if r < 0 and gamma != 0:
+            stpc = stp + r * (stx - stp)
+        elif stp > stx:
+            stpc = stpmax
+        else:
+            stpc = stpmin
+        stpq = stp + dp / (dp - dx) * (stx - stp)
+        if brackt:
+            stpf = stpc if abs(stpc - stp) < abs(stpq - stp) else stpq
+            if stp > stx:
+                stpf = min(stp + 0.66 * (sty - stp), stpf)
+            else:
+                stpf = max(stp + 0.66 * (sty - stp), stpf)
+        else:
+            stpf = stpc if abs(stpc - stp) > abs(stpq - stp) else stpq
+            stpf = min(stpmax, max(stpmin, stpf))
+    else:
+        if brackt:
+            theta = 3 * (fp - fy) / (sty - stp) + dy + dp
+            s = max(abs(theta), abs(dy), abs(dp))
+            gamma = s * np.sqrt(max(0., (theta / s) ** 2 - (dy / s) * (dp / s)))
+            if stp > sty:
+                gamma = -gamma
+            p = (gamma - dp) + theta
+            q = ((gamma - dp) + gamma) + dy
+            stpf = stp + p / q * (sty - stp)
+        elif stp > stx:
+            stpf = stpmax
+        else:
+            stpf = stpmin
+
+    if fp > fx:
+        sty, fy, dy = stp, fp, dp
+    else:
+        if sgnd < 0:
+            sty, fy, dy = stx, fx, dx
+        stx, fx, dx = stp, fp, dp
+    return stx, fx, dx, sty, fy, dy, stpf, brackt
+
+
+# поиск шага с сильными условиями Вольфе (dcsrch из MINPACK-2):
+# phi_dphi(a) -> (phi(a), phi'(a)) одним вычислением;
+# возвращает шаг, phi и phi' в нём и число вычислений
+def more_thuente(phi_dphi, finit, ginit, stp=1., ftol=1e-4, gtol=0.9, xtol=1e-10,
+                 stpmin=0., stpmax=1e10, max_evals=20):
+    stage = 1
+    brackt = False
+    gtest = ftol * ginit
+    width = stpmax - stpmin
+    width1 = 2 * width
+    stx, fx, gx = 0., finit, ginit
+    sty, fy, gy = 0., finit, ginit
+    stmin, stmax = 0., stp + 4 * stp
+
+    for evals in range(1, max_evals + 1):
+        f, g = phi_dphi(stp)
+        stp_eval = stp
+        ftest = finit + stp * gtest
+        if stage == 1 and f <= ftest and g >= 0:
+            stage = 2
+        # сходимость, упор в границы или отрезок уже не сужается
+        if f <= ftest and abs(g) <= gtol * -ginit:
+            break
+        if brackt and (stp <= stmin or stp >= stmax or stmax - stmin <= xtol * stmax):
+            break
+        if stp == stpmax and f <= ftest and g <= gtest:
+            break
+        if stp == stpmin and (f > ftest or g >= gtest):
+            break
+
+        if stage == 1 and fx >= f > ftest:
+            # модифицированная функция psi(a) = phi(a) - phi(0) - a * ftol * phi'(0)
+            stx, fxm, gxm, sty, fym, gym, stp, brackt = _dcstep(
+                stx, fx - stx * gtest, gx - gtest, sty, fy - sty * gtest, gy - gtest,
+                stp, f - stp * gtest, g - gtest, brackt, stmin, stmax)
+            fx, gx = fxm + stx * gtest, gxm + gtest
+            fy, gy = fym + sty * gtest, gym + gtest
+        else:
+            stx, fx, gx, sty, fy, gy, stp, brackt = _dcstep(
+                stx, fx, gx, sty, fy, gy, stp, f, g, brackt, stmin, stmax)
+
+        if brackt:
+            # бисекция, если отрезок сузился недостаточно
+            if abs(sty - stx) >= 0.66 * width1:
+                stp = stx + 0.5 * (sty - stx)
+            width1 = width
+            width = abs(sty - stx)
+            stmin, stmax = min(stx, sty), max(stx, sty)
+        else:
+            stmin, stmax = stp + 1.1 * (stp - stx), stp + 4 * (stp - stx)
+        stp = min(max(stp, stpmin), stpmax)
+        if brackt and (stp <= stmin or stp >= stmax or stmax - stmin <= xtol * stmax):
+            stp = stx
+    else:
+        # вычисления кончились: лучший найденный шаг, если он не нулевой
+        if stx > 0:
+            stp, f, g = stx, fx, gx
+        else:
+            stp = stp_eval
+    return stp, f, g, evals
@@ -3,7 +3,9 @@
 import numpy as np
 
 
-def optimize(a, b, f, eps=1e-5, stat=False):    
+# max_iter=None - без ограничения числа итераций; rtol - остановка, когда
+# длина отрезка меньше rtol от величины точки (для шагов разного масштаба)
+def optimize(a, b, f, eps=1e-5, stat=False, max_iter=15, rtol=0.):    
     K = (5**0.5 - 1) / 2
     I = K * (b - a)      # I_0 = (b - a), I_1 = K * I_0
     
@@ -21,10 +23,10 @@ def optimize(a, b, f, eps=1e-5, stat=False):
     oraclecalls += 2
     cnt = 0
     
-    while I >= eps:
+    while I >= max(eps, rtol * (abs(x) + abs(y)) / 2):
         cnt += 1
-        if cnt > 15:  # 
-            break     #
+        if max_iter is not None and cnt > max_iter:
+            break
         I *= K
         accuracy.append(I)
         iter_nums.append(cnt)
@@ -2,33 +2,149 @@
 
 import numpy as np
 import scipy
-from time import time
-
-class optimize_gd:
-    def __init__(self):
-        self.values = []
-        self.iterations = []
-        self.oracle_calls = []
-        self.times = []
-        self.grads = []
-    
-    def __call__(self, oracle, start_point, line_search_method, tol=1e-8, max_iter=10000):
-        x = start_point
+from scipy.sparse.linalg import eigsh, ArpackNoConvergence
+from time import perf_counter
+
+
+class TraceRecorder:
+    # трасса оптимизатора в заранее выделенных столбцах numpy (при
+    # заполнении ёмкость удваивается): iterations, values, grads,
+    # oracle_calls, steps, times и любые столбцы, переданные в record;
+    # every - писать каждую every-ю итерацию (последняя дописывается в finish),
+    # callback(recorder, k) - после каждой записи, log_every - печать не чаще
+    # раза в log_every секунд; время callback и печати в times не входит
+    def __init__(self, every=1, callback=None, log_every=None, capacity=256):
+        self.every = every
+        self.callback = callback
+        self.log_every = log_every
+        self.capacity = capacity
+        self.start()
+
+    def start(self):
+        self.columns = {}
+        self.n = 0
+        self.pending = None
+        self.paused = 0.
+        self.last_log = -np.inf
+        self.time0 = perf_counter()
+
+    def elapsed(self):
+        return perf_counter() - self.time0 - self.paused
+
+    def record(self, k, value, grad, oracle_calls, step=np.nan, **extra):
+        row = dict(iterations=k, values=value, grads=grad, oracle_calls=oracle_calls,
+                   steps=step, times=self.elapsed(), **extra)
+        if k % self.every:
+            self.pending = row
+        else:
+            self._write(row)
+
+    def finish(self):
+        if self.pending is not None:
+            self._write(self.pending)
+
+    def _write(self, row):
+        self.pending = None
+        if self.n == self.capacity:
+            self.capacity *= 2
+            for name, col in self.columns.items():
+                new = np.zeros((self.capacity,) + col.shape[1:], dtype=col.dtype)
+                new[:self.n] = col[:self.n]
+                self.columns[name] = new
+        for name, value in row.items():
+            col = self.columns.get(name)
+            if col is None:
+                value = np.asarray(value)
+                dtype = value.dtype if value.dtype.kind in "iub" else np.float64
+                # столбец, появившийся позже (например, новый счётчик), - нули до него
+                col = self.columns[name] = np.zeros((self.capacity,) + value.shape, dtype=dtype)
+            col[self.n] = value
+        self.n += 1
+
+        if self.callback is None and self.log_every is None:
+            return
+        t = perf_counter()
+        if self.callback is not None:
+            self.callback(self, row["iterations"])
+        if self.log_every is not None and t - self.last_log >= self.log_every:
+            self.last_log = t
+            print("iteration {}: value {}, grad {}, oracle calls {}".format(
+                row["iterations"], np.squeeze(row["values"]), np.squeeze(row["grads"]),
+                row["oracle_calls"]))
+        self.paused += perf_counter() - t
+
+    # пустой массив, если столбца нет (метод ещё не запускался или его не пишет)
+    def column(self, name):
+        col = self.columns.get(name)
+        return np.empty(0) if col is None else col[:self.n]
+
+    def as_dict(self):
+        return {name: self.column(name) for name in self.columns}
+
+    def export(self, path):
+        np.savez(path, **self.as_dict())
+
+    # значения в старом формате - массив k x 1 x 1, как список 1 x 1 матриц,
+    # чтобы six_plots и one_plot работали без изменений
+    @property
+    def values(self):
+        col = self.column("values")
+        return col.reshape(-1, 1, 1) if col.ndim == 1 else col
+
+
+class Traced:
+    # общая часть оптимизаторов: трасса в self.trace, старые атрибуты
+    # values, iterations, oracle_calls, times, grads - её столбцы
+    def __init__(self, every=1, callback=None, log_every=None):
+        self.trace = TraceRecorder(every, callback, log_every)
+
+    values = property(lambda self: self.trace.values)
+    iterations = property(lambda self: self.trace.column("iterations"))
+    oracle_calls = property(lambda self: self.trace.column("oracle_calls"))
+    times = property(lambda self: self.trace.column("times"))
+    grads = property(lambda self: self.trace.column("grads"))
+    steps = property(lambda self: self.trace.column("steps"))
+    direction_times = property(lambda self: self.trace.column("direction_times"))
+    line_search_times = property(lambda self: self.trace.column("line_search_times"))
+    oracle_times = property(lambda self: self.trace.column("oracle_times"))
+
+
+# время фаз итерации и счётчики оракула (столбцы count_<имя>) для record
+def _phases(oracle, t_direction, t_line_search, t_oracle):
+    extra = dict(direction_times=t_direction, line_search_times=t_line_search,
+                 oracle_times=t_oracle)
+    if oracle.stats is not None:
+        extra.update(("count_" + key, value) for key, value in oracle.stats.items())
+    return extra
+
+# все трассы метода словарём массивов, при path - ещё и в .npz
+def export_traces(method, path=None):
+    if path is not None:
+        method.trace.export(path)
+    return method.trace.as_dict()
+
+
+class optimize_gd(Traced):
+    def __call__(self, oracle, start_point, line_search_method, tol=1e-8, max_iter=10000,
+                 stochastic=False):
+        # состояние метода всегда в float64, даже если оракул считает в float32
+        x = np.asarray(start_point, dtype=np.float64)
 
         oracle_call = 0
 
-        v, g = oracle.fuse_value_grad(x)
+        # stochastic: шаг по мини-батчу StochasticOracle, line search - по нему же
+        f = oracle.batch() if stochastic else oracle
+
+        self.trace.start()
+        t = perf_counter()
+        v, g = f.fuse_value_grad(x)
         oracle_call += 1
+        t_oracle = perf_counter() - t
         d = -g
         d_start = d
         iter_num = 0
-        time0 = time()
 
-        self.values.append(v)
-        self.iterations.append(iter_num)
-        self.oracle_calls.append(oracle_call)
-        self.times.append(0)
-        self.grads.append(1)
+        self.trace.record(iter_num, v.item(), 1., oracle_call, **_phases(oracle, 0, 0, t_oracle))
 
         norm_d_start_sq = d_start.T @ d_start
         # print("norm(d_0)^2: ", norm_d_start_sq[0][0])
@@ -39,74 +155,241 @@ class optimize_gd:
                 print("break")
                 break
 
-            alpha, oraclecalls = line_search_method(oracle, x, d, stata=True)
+            # line search, отдающий значение и градиент в новой точке, экономит
+            # вызов оракула (кроме стохастического режима - там новый батч)
+            reuse = getattr(line_search_method, "returns_value_grad", False) and not stochastic
+            t = perf_counter()
+            if reuse:
+                alpha, oraclecalls, v, g = line_search_method(f, x, d, stata=True, full_output=True)
+            else:
+                alpha, oraclecalls = line_search_method(f, x, d, stata=True)
             oracle_call += oraclecalls
+            t_line_search = perf_counter() - t
 
             x = x + alpha * d
-            v, g = oracle.fuse_value_grad(x)
-            oracle_call += 1
+            if stochastic:
+                oracle.next_batch()
+                f = oracle.batch()
+            t = perf_counter()
+            if not reuse:
+                v, g = f.fuse_value_grad(x)
+                oracle_call += 1
+            t_oracle = perf_counter() - t
+            t = perf_counter()
             d = -g
+            t_direction = perf_counter() - t
 
+            self.trace.record(iter_num, v.item(), (d.T @ d / norm_d_start_sq).item(), oracle_call,
+                              np.asarray(alpha).item(),
+                              **_phases(oracle, t_direction, t_line_search, t_oracle))
 
-            if iter_num % 1000 == 0:
-                print('iteration: {}'.format(iter_num))
-                print('value of CE: {}'.format(v[0][0]))
-                print('norm(d)^2 / norm(d_0)^2:', (d.T @ d / norm_d_start_sq)[0][0])
-                print('alpha', alpha.squeeze())
-                print()
+        self.trace.finish()
+        return x
 
-            self.values.append(v)
-            self.iterations.append(iter_num)
-            self.oracle_calls.append(oracle_call)
-            self.times.append(time() - time0)
-            self.grads.append((d.T @ d / norm_d_start_sq)[0][0])
+class optimize_gd_batch(Traced):
+    # K запусков GD как одна матричная задача: W = [w_1, ..., w_K] размера
+    # d x K, значения и градиенты всех столбцов - один проход по X; шаг
+    # Армихо у каждого столбца свой, сошедшиеся столбцы больше не двигаются
+    def __call__(self, oracle, start_points, tol=1e-8, max_iter=10000, c1=1e-4, eta=2.):
+        W = np.array(start_points, dtype=np.float64)
+        K = W.shape[1]
+
+        oracle_call = 0
+
+        self.trace.start()
+        v, G = oracle.fuse_value_grad(W)
+        oracle_call += 1
+        v = v.reshape(-1)
+        norm_start = np.sum(G * G, axis=0)
+        norm = norm_start
+        active = norm > tol * norm_start
+        alpha = np.ones(K)
+        iter_num = 0
+
+        self.trace.record(iter_num, v, np.ones(K), oracle_call, np.zeros(K))
+
+        while active.any():
+            iter_num += 1
+            if iter_num >= max_iter:
+                print("break")
+                break
+
+            line = oracle.line(W, -G * active)
+            # бэктрекинг по каждому столбцу, начиная с увеличенного прошлого шага;
+            # у сошедшихся направление нулевое, их шаг не трогаем - иначе он
+            # растёт до inf и inf * 0 портит столбец
+            alpha = np.where(active, alpha * eta, alpha)
+            bad = active
+            for _ in range(100):
+                phi = line.value(alpha).reshape(-1)
+                oracle_call += 1
+                bad = active & (phi > v - c1 * alpha * norm)
+                if not bad.any():
+                    break
+                alpha[bad] /= eta
+
+            W = line.accept(alpha)
+            v, G = oracle.fuse_value_grad(W)
+            oracle_call += 1
+            v = v.reshape(-1)
+            norm = np.sum(G * G, axis=0)
+            active = active & (norm > tol * norm_start)
+
+            self.trace.record(iter_num, v, norm / norm_start, oracle_call, alpha)
+
+        self.trace.finish()
+        return W
+
+# optimize_gd_batch из K точек: первая - уже найденный минимум, для неё
+# относительный критерий недостижим и запуск идёт до max_iter, а остальные
+# (случайные) сходятся и тысячи итераций стоят замороженными; все столбцы
+# должны остаться конечными, остальные - сойтись к тому же значению
+def gd_batch_test(oracle, K=3, tol=1e-8, max_iter=10000):
+    W = np.random.randn(oracle.dim, K)
+    W[:, :1] = optimize_gd_batch()(oracle, np.zeros((oracle.dim, 1)), tol, max_iter)
+    method = optimize_gd_batch()
+    W = method(oracle, W, tol, max_iter)
+    values = oracle.value(W).reshape(-1)
+    res = [np.sum(~np.isfinite(W)), np.max(method.grads[-1][1:]), np.max(values) - np.min(values)]
+    print("Нечисловых координат: ", res[0])
+    print("Максимальная относительная норма градиента: ", res[1])
+    print("Разброс значений по столбцам: ", res[2])
+    return res
 
-        return x
-    
     
     
-def hessian_pro(H):
-    flag = True
-    tau = 10**(-8)
-    while flag:
+class ModifiedCholesky:
+    # H + tau I = L L.T: если прошлый H сдвига не потребовал, сначала прямое
+    # разложение - самая дешёвая проверка определённости; иначе (или если оно
+    # не прошло) наименьшее собственное значение H оценивается методом
+    # Ланцоша (O(d^2) на шаг), tau - наибольшее из нужного по оценке сдвига и
+    # сдвига с прошлого вызова, уменьшенного в decay раз, и H раскладывается
+    # один раз; если оценка подвела - один запасной сдвиг по кругам
+    # Гершгорина, после которого H строго диагонально доминирует, то есть
+    # положительно определена; сдвиг прибавляется к диагонали H на месте
+    def __init__(self, tau_min=1e-8, decay=10., lanczos_tol=0.):
+        self.tau_min = tau_min
+        self.decay = decay
+        self.lanczos_tol = lanczos_tol
+        self.tau = 0.
+        self.definite = True
+        self.calls = 0
+        # сколько раз сдвиг был действительно нужен (по оценке или после
+        # неудачного разложения); тёплый старт и tau_floor не считаются
+        self.shifted = 0
+
+    # нижняя оценка lambda_min(H) по кругам Гершгорина
+    @staticmethod
+    def _gershgorin(H, h):
+        return np.min(h - (np.abs(H).sum(axis=1) - np.abs(h)))
+
+    def _lambda_min(self, H, h):
+        if H.shape[0] <= 2:
+            return np.linalg.eigvalsh(H)[0]
         try:
-            L = np.linalg.cholesky(H)
-            flag = False
-        except:
-            tau *= 2
-            H += tau * np.eye(H.shape[0])
-    return L
-
-class optimize_newton:
-    def __init__(self):
-        self.values = []
-        self.iterations = []
-        self.oracle_calls = []
-        self.times = []
-        self.grads = []
+            return eigsh(H, k=1, which="SA", tol=self.lanczos_tol,
+                         return_eigenvectors=False)[0]
+        except ArpackNoConvergence:
+            return self._gershgorin(H, h)
+
+    def _factor(self, H, stats):
+        if stats is not None:
+            stats["cholesky"] += 1
+        return np.linalg.cholesky(H)
+
+    # tau_floor - наименьший допустимый сдвиг
+    def __call__(self, H, stats=None, tau_floor=0.):
+        diag = np.diag_indices_from(H)
+        self.calls += 1
+        h = H[diag].copy()
+        if self.definite:
+            H[diag] = h + tau_floor
+            try:
+                L = self._factor(H, stats)
+                self.tau = tau_floor
+                return L
+            except np.linalg.LinAlgError:
+                pass
+        base = self.tau_min * max(1., np.max(np.abs(h)))
+        H[diag] = h
+        lam = self._lambda_min(H, h)
+        need = base - lam if lam < base else 0.
+        warm = self.tau / self.decay
+        if warm < base:
+            warm = 0.
+        tau = max(need, warm, tau_floor)
+        H[diag] = h + tau
+        try:
+            L = self._factor(H, stats)
+        except np.linalg.LinAlgError:
+            delta = max(0., -self._gershgorin(H, H[diag])) + base
+            H[diag] += delta
+            tau += delta
+            need = tau
+            L = self._factor(H, stats)
+        self.tau = tau
+        self.definite = need == 0
+        self.shifted += need > 0
+        return L
+
+# разложение без памяти о прошлом сдвиге
+def hessian_pro(H, stats=None):
+    return ModifiedCholesky()(H, stats)
+
+# шаг Ньютона при dim > n: H = B.T @ B, B = diag(D)^(1/2) X ранга не больше n,
+# по формуле Вудбери (H + tau I)^(-1) g = (g - B.T @ S^(-1) @ B @ g) / tau,
+# S = tau I + B @ B.T - n x n матрица, подобная tau D^(-1) + X @ X.T, но без
+# деления на нулевые веса; сдвиг tau > 0 обязателен, H вырожден
+def woodbury_direction(oracle, weights, g, cholesky):
+    s = np.sqrt(weights)
+    S = s * oracle.kernel() * s.T
+    tau_floor = cholesky.tau_min * max(1., np.max(np.diag(S)))
+    L = cholesky(S, oracle.stats, tau_floor)
+    u = scipy.linalg.cho_solve((L, True), s * oracle._matvec(g))
+    return - (g - oracle._rmatvec(s * u)) / cholesky.tau
+
+class optimize_newton(Traced):
+    # сдвиг tau модифицированного Холецкого на каждой итерации
+    shifts = property(lambda self: self.trace.column("shifts"))
+
+    # H - гессиан, при wide - веса D
+    def _direction(self, oracle, g, H):
+        if self.wide:
+            d = woodbury_direction(oracle, H, g, self.cholesky)
+        else:
+            L = self.cholesky(H, oracle.stats)
+            d = scipy.linalg.cho_solve((L, True), -g)
+        norm_d = d.T @ d
+        if norm_d ** 0.5 >= 1000:
+            d = d / (norm_d ** 0.5)
+        return d
 
     def __call__(self, oracle, start_point, line_search_method, tol=1e-8, max_iter=100):
-        x = start_point
+        # состояние метода всегда в float64, даже если оракул считает в float32
+        x = np.asarray(start_point, dtype=np.float64)
 
         oracle_call = 0
 
-        v, g, H = oracle.fuse_value_grad_hessian(x)
+        self.trace.start()
+        self.cholesky = ModifiedCholesky()
+        # признаков больше, чем объектов: d x d гессиан не строится
+        self.wide = oracle.sample_space and oracle.dim > oracle.vol
+        t = perf_counter()
+        if self.wide:
+            v, g, H = oracle.fuse_value_grad_curvature(x)
+        else:
+            v, g, H = oracle.fuse_value_grad_hessian(x)
         oracle_call += 1
-        L = hessian_pro(H)
-        d = scipy.linalg.cho_solve((L.T, L), -g)
-        norm_d = d.T @ d
-        if norm_d ** 0.5 >= 1000:
-            d = d / (norm_d ** 0.5)
+        t_oracle = perf_counter() - t
+        t = perf_counter()
+        d = self._direction(oracle, g, H)
+        t_direction = perf_counter() - t
             
         g_start = g
         iter_num = 0
-        time0 = time()
 
-        self.values.append(v)
-        self.iterations.append(iter_num)
-        self.oracle_calls.append(oracle_call)
-        self.times.append(0)
-        self.grads.append(((g.T @ g) / (g_start.T @ g_start))[0][0])
+        self.trace.record(iter_num, v.item(), ((g.T @ g) / (g_start.T @ g_start)).item(), oracle_call,
+                          shifts=self.cholesky.tau, **_phases(oracle, t_direction, 0, t_oracle))
 
         while (g.T @ g) / (g_start.T @ g_start) > tol:                              
             iter_num += 1
@@ -114,31 +397,34 @@ class optimize_newton:
                 print("break")
                 break
 
-            alpha, oraclecalls = line_search_method(oracle, x, d, stata=True)
+            reuse = getattr(line_search_method, "returns_value_grad", False)
+            t = perf_counter()
+            if reuse:
+                alpha, oraclecalls, v, g = line_search_method(oracle, x, d, stata=True, full_output=True)
+            else:
+                alpha, oraclecalls = line_search_method(oracle, x, d, stata=True)
             oracle_call += oraclecalls
+            t_line_search = perf_counter() - t
 
             x = x + alpha * d
-            v, g, H = oracle.fuse_value_grad_hessian(x)
+            t = perf_counter()
+            if reuse:
+                H = oracle.curvature(x) if self.wide else oracle.hessian(x)
+            elif self.wide:
+                v, g, H = oracle.fuse_value_grad_curvature(x)
+            else:
+                v, g, H = oracle.fuse_value_grad_hessian(x)
             oracle_call += 1
-            L = hessian_pro(H)
-            d = scipy.linalg.cho_solve((L.T, L), -g)
-             
-            norm_d = d.T @ d
-            if norm_d ** 0.5 >= 1000:
-                d = d / (norm_d ** 0.5)
-            
-            print('iteration: {}'.format(iter_num))
-            print('value of CE: {}'.format(v[0][0]))
-            print('norm(grad)^2 / norm(grad_0)^2:', (g.T @ g)[0][0] / (g_start.T @ g_start)[0][0])
-            print('alpha', alpha.squeeze())
-            print() 
-
-            self.values.append(v)
-            self.iterations.append(iter_num)
-            self.oracle_calls.append(oracle_call)
-            self.times.append(time() - time0)
-            self.grads.append(((g.T @ g) / (g_start.T @ g_start))[0][0])
+            t_oracle = perf_counter() - t
+            t = perf_counter()
+            d = self._direction(oracle, g, H)
+            t_direction = perf_counter() - t
+
+            self.trace.record(iter_num, v.item(), ((g.T @ g) / (g_start.T @ g_start)).item(),
+                              oracle_call, np.asarray(alpha).item(), shifts=self.cholesky.tau,
+                              **_phases(oracle, t_direction, t_line_search, t_oracle))
 
+        self.trace.finish()
         return x
     
 
@@ -157,26 +443,78 @@ def eta4(norm_r_sq):
 def eta5(norm_r_sq):
     return 0.9
 
-def CG(oracle, g, x, eta_fun, max_iter=1000):
+class EisenstatWalker:
+    # адаптивная точность CG (вторая схема Айзенштата-Уокера):
+    # eta_k = gamma (|g_k| / |g_{k-1}|)^alpha, но не меньше gamma eta_{k-1}^alpha,
+    # если та больше 0.1 - чтобы eta не падала резко; состояние между
+    # внешними итерациями, reset() - в начале запуска
+    def __init__(self, eta0=0.5, gamma=0.9, alpha=2., eta_max=0.9):
+        self.eta0 = eta0
+        self.gamma = gamma
+        self.alpha = alpha
+        self.eta_max = eta_max
+        self.reset()
+
+    def reset(self):
+        self.eta = None
+        self.norm_prev = None
+
+    def __call__(self, norm_r_sq):
+        norm = np.asarray(norm_r_sq).item() ** 0.5
+        if self.norm_prev is None:
+            eta = self.eta0
+        else:
+            eta = self.gamma * (norm / self.norm_prev) ** self.alpha
+            safe = self.gamma * self.eta ** self.alpha
+            if safe > 0.1:
+                eta = max(eta, safe)
+            eta = min(eta, self.eta_max)
+        self.eta = eta
+        self.norm_prev = norm
+        return eta
+
+
+# z0 - тёплый старт (направление с прошлой итерации): растягивается до
+# минимума квадратичной модели вдоль z0, если это направление спуска;
+# precondition - предобусловливание Якоби диагональю гессиана
+def CG(oracle, g, x, eta_fun, max_iter=1000, z0=None, precondition=False):
     f_calls = 0
+    # гессиан в точке x: веса p * (1 - p) считаются один раз на весь CG
+    H = oracle.hessian_operator(x)
     # инициализируем неточное решение системы
-    z = np.zeros(oracle.X.shape[1]).reshape(-1, 1)
+    z = np.zeros(H.shape[1]).reshape(-1, 1)
     r = g
-    d = -g
-    norm_r_sq = r.T @ r
+    warm = False
+    if z0 is not None and (g.T @ z0).item() < 0:
+        Hz = H @ z0
+        f_calls += 1
+        zHz = (z0.T @ Hz).item()
+        if zHz > 0:
+            c = - (g.T @ z0).item() / zHz
+            z = c * z0
+            r = g + c * Hz
+            warm = True
+    if precondition:
+        M = H.diagonal()
+        M[M <= 0] = 1.
+    y = r / M if precondition else r
+    d = -y
+    norm_r_sq = r.T @ y
 
     # точность решения системы
     # eta = min(0.5, norm_r_sq**0.25) 
-    eta = eta_fun(norm_r_sq)
-    eps = eta * norm_r_sq**0.5
-    
+    eta = eta_fun(g.T @ g)
+    eps = eta * (g.T @ g)**0.5
+    if warm and (r.T @ r)**0.5 < eps:
+        return z, f_calls
+
     for j in range(max_iter):
-        Bd = oracle.hessian_vec_product(x, d)
+        Bd = H @ d
         f_calls += 1
         
         dBd = d.T @ Bd
         if dBd <= 0:
-            if j == 0:
+            if j == 0 and not warm:
                 return d, f_calls
             else:
                 return z, f_calls
@@ -184,64 +522,68 @@ def CG(oracle, g, x, eta_fun, max_iter=1000):
         alpha = norm_r_sq / dBd
         z += alpha * d
         r_new = r + alpha * Bd
-        norm_r_new_sq = r_new.T @ r_new
         
-        if norm_r_new_sq**0.5 < eps:
+        if (r_new.T @ r_new)**0.5 < eps:
             return z, f_calls
         
+        y = r_new / M if precondition else r_new
+        norm_r_new_sq = r_new.T @ y
         beta = norm_r_new_sq / norm_r_sq
-        d = -r_new + beta * d
+        d = -y + beta * d
         r = r_new
         norm_r_sq = norm_r_new_sq
-        
 
-class hfn_optimize:
-    def __init__(self):
-        self.values = []
-        self.iterations = []
-        self.oracle_calls = []
-        self.times = []
-        self.grads = []
+    return z, f_calls
         
-    def __call__(self, oracle, start_point, line_search_method, eta_fun, tol=1e-8, max_iter=1000): 
-        x = start_point
+
+class hfn_optimize(Traced):
+    # число умножений гессиана на вектор в CG на каждой итерации
+    cg_iters = property(lambda self: self.trace.column("cg_iters"))
+
+    def __call__(self, oracle, start_point, line_search_method, eta_fun, tol=1e-8, max_iter=1000,
+                 precondition=False, warm_start=False, cg_max_iter=1000):
+        # состояние метода всегда в float64, даже если оракул считает в float32
+        x = np.asarray(start_point, dtype=np.float64)
         
         oracle_call = 0
-        time0 = time()
-
+        self.trace.start()
+        if hasattr(eta_fun, "reset"):
+            eta_fun.reset()
+        z = None
 
         for k in range(max_iter):
+            t = perf_counter()
             v, g = oracle.fuse_value_grad(x)
             oracle_call += 1
+            t_oracle = perf_counter() - t
             if k == 0:
                 g_start = g
 
             if g.T @ g <= tol:
                 break
 
-            p, f_calls = CG(oracle, g, x, eta_fun, max_iter=1000)
+            t = perf_counter()
+            p, f_calls = CG(oracle, g, x, eta_fun, max_iter=cg_max_iter,
+                            z0=z if warm_start else None, precondition=precondition)
             oracle_call += f_calls
+            z = p
             
             norm_p = p.T @ p
             if norm_p ** 0.5 >= 1000:
                 p = p / (norm_p ** 0.5)
+            t_direction = perf_counter() - t
                 
+            t = perf_counter()
             alpha, funcalls = line_search_method(oracle, x, p, stata=True)
             oracle_call += funcalls           
+            t_line_search = perf_counter() - t
                 
             x = x + alpha * p
 
-            print('iteration: {}'.format(k))
-            print('value of CE: {}'.format(v[0][0]))
-            print('norm_grad_sq:', (g.T @ g)[0][0])
-            print('alpha', alpha.squeeze())
-            print() 
-
-            self.values.append(v)
-            self.iterations.append(k)
-            self.oracle_calls.append(oracle_call)
-            self.times.append(time() - time0)
-            self.grads.append(((g.T @ g) / (g_start.T @ g_start))[0][0])
+            self.trace.record(k, v.item(), ((g.T @ g) / (g_start.T @ g_start)).item(), oracle_call,
+                              np.asarray(alpha).item(), cg_iters=f_calls,
+                              **_phases(oracle, t_direction, t_line_search, t_oracle))
 
+        self.trace.finish()
         return x
 
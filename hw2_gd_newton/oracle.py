@@ -1,97 +1,853 @@
 #!/usr/bin/env python
 
+import hashlib
+import os
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from scipy.special import expit as sigmoid
+from scipy.special import logsumexp, softmax
 import numpy as np
 import pandas as pd
 import scipy
+from scipy.linalg.blas import dsyrk
+from scipy.sparse.linalg import LinearOperator
 from sklearn.datasets import load_svmlight_file
 
 class Oracle:
-    def __init__(self, X, y):
+    # гессиан X.T @ diag(D) @ X: шаг Ньютона можно считать через n x n
+    # матрицу в пространстве объектов
+    sample_space = True
+
+    def __init__(self, X, y, cache_size=0, dtype=np.float64, num_threads=1,
+                 implicit_intercept=False):
+        # CSR: быстрые умножения и срезы по строкам
+        if scipy.sparse.issparse(X) and X.format != "csr":
+            X = X.tocsr()
+        # X хранится в dtype (например, float32), а отступы, значение и
+        # градиент приводятся к float64
+        self.dtype = np.dtype(dtype)
+        if X.dtype != self.dtype:
+            X = X.astype(self.dtype)
         self.X = X
         self.y = y
         self.vol = len(y)
-    
+
+        # implicit_intercept: столбца единиц в X нет, свободный член - последняя
+        # координата w, X @ w[:-1] + w[-1]; размерность w - self.dim
+        self.implicit_intercept = implicit_intercept
+        self.dim = X.shape[1] + int(implicit_intercept)
+
+        # num_threads > 1: X режется на num_threads блоков строк, умножения
+        # по блокам идут в пуле потоков (scipy и numpy отпускают GIL),
+        # частичные градиенты складываются всегда в одном порядке
+        self.num_threads = num_threads
+        if num_threads > 1:
+            bounds = np.linspace(0, X.shape[0], num_threads + 1).astype(int)
+            self.shards = [(start, stop, row_slice(X, start, stop))
+                           for start, stop in zip(bounds[:-1], bounds[1:])]
+            self.pool = ThreadPoolExecutor(num_threads)
+            # потоки пула останавливаются по close() или вместе с оракулом
+            self._shutdown = weakref.finalize(self, self.pool.shutdown, wait=False)
+
+        # LRU-кэш: точка w -> (X @ w, sigmoid(X @ w), y - sigmoid(X @ w))
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # без кэша - состояние последней принятой line search точки: следующий
+        # вызов оракула в ней (и line search из неё) не умножает на X заново
+        self._accepted = None
+
+        # счётчики умножений на X / X.T, вычислений sigmoid, построений
+        # гессиана и разложений Холецкого; None - выключены
+        self.stats = None
+
+        # X @ X.T, строится при первом вызове kernel()
+        self._kernel = None
+        # поэлементные квадраты X для диагонали гессиана
+        self._X_sq = None
+
+    def instrument(self, enable=True):
+        self.stats = Counter() if enable else None
+        return self
+
+    def _count(self, key, k=1):
+        if self.stats is not None:
+            self.stats[key] += k
+
+    def _state(self, w):
+        if self.cache_size <= 0:
+            if self._accepted is not None and np.array_equal(self._accepted[0], w):
+                return self._accepted[1]
+            return self._compute_state(w)
+        key = (w.shape, w.dtype.str, w.tobytes())
+        state = self.cache.get(key)
+        if state is not None:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return state
+        self.cache_misses += 1
+        state = self._compute_state(w)
+        self._store(key, state)
+        return state
+
+    def _store(self, key, state):
+        self.cache[key] = state
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _remember(self, w, state):
+        if self.cache_size > 0:
+            self._store((w.shape, w.dtype.str, w.tobytes()), state)
+        else:
+            self._accepted = (np.copy(w), state)
+
+    # состояние в w уже посчитано (в кэше или принятая точка)
+    def _known(self, w):
+        if self.cache_size > 0:
+            return (w.shape, w.dtype.str, w.tobytes()) in self.cache
+        return self._accepted is not None and np.array_equal(self._accepted[0], w)
+
+    def _matvec(self, w):
+        self._count("matvec")
+        if self.implicit_intercept:
+            b = w[-1:].astype(np.float64)
+            w = w[:-1]
+        w = w.astype(self.dtype, copy=False)
+        if self.num_threads > 1:
+            z = np.concatenate(list(self.pool.map(lambda shard: shard[2] @ w, self.shards)))
+        else:
+            z = self.X @ w
+        z = z.astype(np.float64, copy=False)
+        if self.implicit_intercept:
+            z += b
+        return z
+
+    def _rmatvec(self, r):
+        self._count("rmatvec")
+        rc = r.astype(self.dtype, copy=False)
+        if self.num_threads > 1:
+            parts = self.pool.map(lambda shard: shard[2].T @ rc[shard[0]:shard[1]], self.shards)
+            g = None
+            for part in parts:
+                g = part.astype(np.float64) if g is None else g + part
+        else:
+            g = (self.X.T @ rc).astype(np.float64, copy=False)
+        if self.implicit_intercept:
+            # производная по свободному члену - сумма остатков
+            g = np.concatenate([g, r.sum(axis=0, keepdims=True)])
+        return g
+
+    def _compute_state(self, w):
+        return self._link(self._matvec(w))
+
+    # отступы -> (z, вероятности, остатки)
+    def _link(self, z):
+        self._count("sigmoid")
+        p = sigmoid(z)
+        return z, p, self.y - p
+
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "size": len(self.cache), "max_size": self.cache_size}
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._accepted = None
+
+    def close(self):
+        if self.num_threads > 1:
+            self._shutdown()
+
+    # -y log(sigmoid(z)) - (1 - y) log(1 - sigmoid(z)) = log(1 + e^z) - y z,
+    # logaddexp не переполняется и не требует сдвига delta
+    def _value(self, z):
+        return (np.logaddexp(0, z).sum(axis=0) - self.y.T @ z) / self.vol
+
+    def _grad(self, r):
+        return - self._rmatvec(r) / self.vol
+
+    # производная вдоль направления d, u = X @ d
+    def _line_grad(self, u, r):
+        return - u.T @ r / self.vol
+
     # скаляр
     def value(self, w): 
-        delta = 10 ** (-8)
-        p = sigmoid(self.X @ w)
-        return -(self.y.T @ np.log(p + delta) + (1 - self.y).T @ np.log(1 - p + delta)) / self.vol
+        z, _, _ = self._state(w)
+        return self._value(z)
 
     # вектор
     def grad(self, w):
-        p = sigmoid(self.X @ w)
-        return - self.X.T @ (self.y - p) / self.vol
+        _, _, r = self._state(w)
+        return self._grad(r)
+
+    def _hessian(self, p):
+        return self._weighted_gram(p * (1 - p) / self.vol)
+
+    # X.T @ diag(weights) @ X, для свободного члена - с окаймлением
+    def _weighted_gram(self, weights):
+        H = gram(self.X, weights)
+        if self.implicit_intercept:
+            # окаймление: [[X.T W X, X.T w], [w.T X, sum(w)]]
+            d = self.X.shape[1]
+            H_full = np.empty((d + 1, d + 1), order="F")
+            H_full[:d, :d] = H
+            H_full[:, d] = H_full[d, :] = self._rmatvec(weights).reshape(-1)
+            H = H_full
+        return H
+
+    # n x n матрица X @ X.T (свободный член - столбец единиц), от w не зависит
+    def kernel(self):
+        if self._kernel is None:
+            self._count("kernel")
+            X = self.X.astype(np.float64, copy=False)
+            K = X @ X.T
+            K = K.toarray() if scipy.sparse.issparse(K) else np.asarray(K)
+            if self.implicit_intercept:
+                K += 1
+            self._kernel = K
+        return self._kernel
+
+    # диагональ X.T @ diag(weights) @ X = (X ** 2).T @ weights
+    def _gram_diag(self, weights):
+        if self._X_sq is None:
+            self._X_sq = (self.X.multiply(self.X).tocsr() if scipy.sparse.issparse(self.X)
+                          else self.X ** 2)
+        D = (self._X_sq.T @ weights.astype(self.dtype, copy=False)).astype(np.float64, copy=False)
+        if self.implicit_intercept:
+            D = np.concatenate([D, weights.sum(axis=0, keepdims=True)])
+        return D
+
+    # X.T @ (weights * (X @ v))
+    def _gram_vec(self, weights, v):
+        return self._rmatvec(weights * self._matvec(v))
+
+    def _hessian_vec_product(self, p, d):
+        return self._gram_vec(p * (1 - p), d) / self.vol
 
     # матрица
     def hessian(self, w): 
-        p = sigmoid(self.X @ w)
-        return self.X.T @ np.diagflat(p * (1 - p)) @ self.X / self.vol
+        _, p, _ = self._state(w)
+        self._count("hessian")
+        return self._hessian(p)
 
     def hessian_vec_product(self, w, d):
-        u1 = self.X @ d
-        p = sigmoid(self.X @ w)
-        u2 = np.diagflat(p * (1 - p)) @ u1
-        u3 = self.X.T @ u2
-        return u3 / self.vol
+        _, p, _ = self._state(w)
+        return self._hessian_vec_product(p, d)
+
+    # веса D гессиана X.T @ diag(D) @ X
+    def curvature(self, w):
+        _, p, _ = self._state(w)
+        return p * (1 - p) / self.vol
+
+    # гессиан в фиксированной точке w как линейный оператор
+    def hessian_operator(self, w):
+        _, p, _ = self._state(w)
+        return HessianOperator(self, p * (1 - p))
 
     def fuse_value_grad(self, w):
-        return self.value(w), self.grad(w)
+        z, _, r = self._state(w)
+        return self._value(z), self._grad(r)
+
+    def line(self, w, d):
+        return LineOracle(self, w, d)
 
     def fuse_value_grad_hessian(self, w):
-        return self.value(w), self.grad(w), self.hessian(w)
+        z, p, r = self._state(w)
+        self._count("hessian")
+        return self._value(z), self._grad(r), self._hessian(p)
+
+    def fuse_value_grad_curvature(self, w):
+        z, p, r = self._state(w)
+        return self._value(z), self._grad(r), p * (1 - p) / self.vol
 
     def fuse_value_grad_hessian_vec_product(self, w, d):
-        return self.value(w), self.grad(w), self.hessian_vec_product(w, d)
+        z, p, r = self._state(w)
+        return self._value(z), self._grad(r), self._hessian_vec_product(p, d)
+
+
+def gram(X, weights, chunk_size=4096):
+    # X.T @ diag(weights) @ X без диагональной n x n матрицы: строки X
+    # масштабируются на sqrt(weights) и суммируются блоками по chunk_size
+    n, d = X.shape
+    H = np.zeros((d, d), order="F")
+    sqrt_w = np.sqrt(weights).reshape(-1, 1)
+    sparse = scipy.sparse.issparse(X)
+    if sparse and X.format != "csr":
+        X = X.tocsr()
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        if sparse:
+            Xc = scipy.sparse.csr_matrix(X[start:stop].multiply(sqrt_w[start:stop]))
+            G = (Xc.T @ Xc).tocoo()
+            H[G.row, G.col] += G.data
+        else:
+            Xc = np.asarray(X[start:stop]) * sqrt_w[start:stop]
+            # SYRK считает только верхний треугольник
+            H = dsyrk(1.0, Xc, beta=1.0, c=H, trans=1, overwrite_c=1)
+    if not sparse:
+        lower = np.tril_indices(d, -1)
+        H[lower] = H.T[lower]
+    return H
+
+
+class HessianOperator(LinearOperator):
+    # H v = X.T @ (weights * (X @ v)) / n, веса p * (1 - p) считаются один раз
+    def __init__(self, oracle, weights):
+        self.oracle = oracle
+        self.weights = weights
+        super().__init__(dtype=np.float64, shape=(oracle.dim, oracle.dim))
+
+    def _matvec(self, v):
+        return self.oracle._gram_vec(self.weights, v.reshape(-1, 1)) / self.oracle.vol
+
+    def _rmatvec(self, v):
+        return self._matvec(v)
+
+    def _matmat(self, V):
+        return self.oracle._gram_vec(self.weights, V) / self.oracle.vol
+
+    # диагональ гессиана столбцом, для предобусловливания
+    def diagonal(self):
+        return self.oracle._gram_diag(self.weights) / self.oracle.vol
+
+
+def row_slice(X, start, stop):
+    # срез строк CSR без копирования data и indices
+    if not scipy.sparse.issparse(X):
+        return X[start:stop]
+    indptr = X.indptr[start:stop + 1]
+    return scipy.sparse.csr_matrix(
+        (X.data[indptr[0]:indptr[-1]], X.indices[indptr[0]:indptr[-1]], indptr - indptr[0]),
+        shape=(stop - start, X.shape[1]), copy=False)
+
+
+class StochasticOracle(Oracle):
+    # строки перемешиваются один раз при создании, поэтому мини-батч -
+    # это непрерывный срез строк, а эпоха - один последовательный проход по X
+    def __init__(self, X, y, batch_size=256, growth=1., seed=None, **kwargs):
+        if scipy.sparse.issparse(X):
+            X = X.tocsr()
+        perm = np.random.RandomState(seed).permutation(len(y))
+        super().__init__(X[perm], y[perm], **kwargs)
+        self.batch_size = batch_size
+        # после каждого шага размер батча умножается на growth
+        self.growth = growth
+        self.start = 0
+        self.epoch = 0
+        self._batch = None
+
+    def batch(self):
+        if self._batch is None:
+            stop = self.start + int(self.batch_size)
+            if stop <= self.vol:
+                X, y = row_slice(self.X, self.start, stop), self.y[self.start:stop]
+            else:
+                # хвост эпохи дополняется строками из начала следующей, чтобы
+                # размер батча шёл по расписанию
+                stop -= self.vol
+                parts = [row_slice(self.X, self.start, self.vol), row_slice(self.X, 0, stop)]
+                X = (scipy.sparse.vstack(parts, format="csr") if scipy.sparse.issparse(self.X)
+                     else np.vstack(parts))
+                y = np.concatenate([self.y[self.start:], self.y[:stop]])
+            self._batch = Oracle(X, y, cache_size=self.cache_size, dtype=self.dtype,
+                                 num_threads=self.num_threads,
+                                 implicit_intercept=self.implicit_intercept)
+            # счётчики батчей копятся в общем Counter
+            self._batch.stats = self.stats
+        return self._batch
+
+    def next_batch(self):
+        self.start += int(self.batch_size)
+        if self.start >= self.vol:
+            self.start -= self.vol
+            self.epoch += 1
+        self.batch_size = min(self.vol, self.batch_size * self.growth)
+        self._close_batch()
+
+    def _close_batch(self):
+        if self._batch is not None:
+            self._batch.close()
+        self._batch = None
+
+    def close(self):
+        self._close_batch()
+        super().close()
+
+    def value_batch(self, w):
+        return self.batch().value(w)
+
+    def grad_batch(self, w):
+        return self.batch().grad(w)
+
+    def fuse_value_grad_batch(self, w):
+        return self.batch().fuse_value_grad(w)
+
+
+class SoftmaxOracle(Oracle):
+    # мультиномиальная логистическая регрессия: веса - матрица m x C
+    # (m = X.shape[1] + свободный член), хранится столбцом w = W.reshape(-1, 1, order="F"),
+    # так что оптимизаторы и line search работают с ней как с обычным вектором;
+    # отступы всех классов - одно умножение X @ W; блок из K точек (dim x K)
+    # даёт отступы n x C x K, значения 1 x K и градиенты dim x K
+    # гессиан блочный, не X.T @ diag(D) @ X
+    sample_space = False
 
+    def __init__(self, X, y, **kwargs):
+        self.classes, labels = np.unique(np.asarray(y).reshape(-1), return_inverse=True)
+        self.n_classes = len(self.classes)
+        Y = np.zeros((len(labels), self.n_classes))
+        Y[np.arange(len(labels)), labels] = 1
+        super().__init__(X, Y, **kwargs)
+        self.n_features = self.dim
+        self.dim = self.n_features * self.n_classes
 
-def make_oracle(data_path, format="libsvm"):
+    def unpack(self, w):
+        return w.reshape((self.n_features, self.n_classes), order="F")
+
+    def pack(self, W):
+        return W.reshape(-1, 1, order="F")
+
+    # K точек - одно умножение X на m x (C K)
+    def _matvec(self, w):
+        K = w.shape[1] if w.ndim == 2 else 1
+        if K == 1:
+            return super()._matvec(self.unpack(w))
+        z = super()._matvec(w.reshape((self.n_features, self.n_classes * K), order="F"))
+        return z.reshape((self.vol, self.n_classes, K), order="F")
+
+    def _rmatvec(self, r):
+        if r.ndim < 3:
+            return self.pack(super()._rmatvec(r))
+        g = super()._rmatvec(r.reshape((self.vol, -1), order="F"))
+        return g.reshape((self.dim, r.shape[2]), order="F")
+
+    # метки под форму отступов: n x C или n x C x 1
+    def _labels(self, z):
+        return self.y if z.ndim == 2 else self.y[:, :, None]
+
+    def _link(self, z):
+        self._count("softmax")
+        p = softmax(z, axis=1)
+        return z, p, self._labels(z) - p
+
+    # sum_i (logsumexp(z_i) - z_{i, y_i}) / n
+    def _value(self, z):
+        return ((logsumexp(z, axis=1).sum(axis=0) - np.sum(self._labels(z) * z, axis=(0, 1)))
+                / self.vol).reshape(1, -1)
+
+    def _line_grad(self, u, r):
+        return (- np.sum(u * r, axis=(0, 1)) / self.vol).reshape(1, -1)
+
+    def _hessian_vec_product(self, p, d):
+        return self._gram_vec(p, d) / self.vol
+
+    # H v = X.T @ (P * U - P * sum(P * U)), U = X @ V: блоки гессиана
+    # X.T @ diag(p_a (delta_ab - p_b)) @ X не строятся
+    def _gram_vec(self, p, v):
+        U = self._matvec(v)
+        if U.ndim == 3:
+            p = p[:, :, None]
+        PU = p * U
+        return self._rmatvec(PU - p * PU.sum(axis=1, keepdims=True))
+
+    def hessian_operator(self, w):
+        _, p, _ = self._state(w)
+        return HessianOperator(self, p)
+
+    # диагональные блоки гессиана - X.T @ diag(p_a (1 - p_a)) @ X
+    def _gram_diag(self, p):
+        return self.pack(super()._gram_diag(p * (1 - p)))
+
+    # полный гессиан (m C) x (m C) из C (C + 1) / 2 взвешенных матриц Грама
+    def _hessian(self, p):
+        m, C = self.n_features, self.n_classes
+        H = np.empty((m * C, m * C), order="F")
+        for a in range(C):
+            for b in range(a, C):
+                if a == b:
+                    block = self._weighted_gram(p[:, a] * (1 - p[:, a]) / self.vol)
+                else:
+                    block = - self._weighted_gram(p[:, a] * p[:, b] / self.vol)
+                H[a * m:(a + 1) * m, b * m:(b + 1) * m] = block
+                H[b * m:(b + 1) * m, a * m:(a + 1) * m] = block.T
+        return H
+
+
+class ChunkedCSR:
+    # матрица на диске: блоки строк CSR (data, indices, indptr) в .npy,
+    # открываются через memmap; при обходе следующий блок читается в
+    # фоновом потоке, пока считается текущий
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.shape = tuple(int(k) for k in np.load(os.path.join(path, "shape.npy")))
+        self.dtype = np.load(os.path.join(path, "data_0.npy"), mmap_mode="r").dtype
+        self.n_chunks = len(self.offsets) - 1
+        self.loader = ThreadPoolExecutor(1)
+        weakref.finalize(self, self.loader.shutdown, wait=False)
+
+    def load(self, i):
+        arrays = [np.array(np.load(os.path.join(self.path, "%s_%d.npy" % (name, i)), mmap_mode="r"))
+                  for name in ("data", "indices", "indptr")]
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return start, stop, scipy.sparse.csr_matrix(tuple(arrays), shape=(stop - start, self.shape[1]))
+
+    def __iter__(self):
+        future = self.loader.submit(self.load, 0)
+        for i in range(self.n_chunks):
+            chunk = future.result()
+            if i + 1 < self.n_chunks:
+                future = self.loader.submit(self.load, i + 1)
+            yield chunk
+
+
+def save_chunks(X, y, path, chunk_size=100000):
+    # X, y -> каталог path в формате ChunkedCSR
+    X = scipy.sparse.csr_matrix(X)
+    os.makedirs(path, exist_ok=True)
+    offsets = list(range(0, X.shape[0], chunk_size)) + [X.shape[0]]
+    for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        _save_chunk(path, i, X[start:stop])
+    np.save(os.path.join(path, "offsets.npy"), np.array(offsets))
+    np.save(os.path.join(path, "shape.npy"), np.array(X.shape))
+    np.save(os.path.join(path, "y.npy"), np.asarray(y, dtype=np.float64).reshape(-1, 1))
+
+
+def _save_chunk(path, i, X):
+    for name in ("data", "indices", "indptr"):
+        np.save(os.path.join(path, "%s_%d.npy" % (name, i)), getattr(X, name))
+
+
+def libsvm_to_chunks(data_path, path, n_features=None, chunk_bytes=2**27, dtype=np.float64,
+                     zero_based="auto"):
+    # libsvm-файл -> ChunkedCSR кусками по chunk_bytes байт, без загрузки
+    # всего файла в память; столбец единиц и метки - как в make_oracle
+    size = os.path.getsize(data_path)
+    starts = range(0, size, chunk_bytes)
+    # zero_based="auto", как в make_oracle: индексы с нуля, если где-то встречается
+    # 0; решается один раз на весь файл (по проходу ниже или, если n_features
+    # задано, по первому куску), иначе куски без нулевого индекса сдвинулись бы
+    if n_features is None or zero_based == "auto":
+        # лишний проход по файлу (или первому куску), индексы как в файле
+        low, high = np.inf, 0
+        for start in (starts if n_features is None else starts[:1]):
+            X, _ = load_svmlight_file(data_path, n_features=np.iinfo(np.int32).max - 1,
+                                      zero_based=True, offset=start, length=chunk_bytes)
+            if X.nnz:
+                low = min(low, X.indices.min())
+                high = max(high, X.indices.max())
+        if zero_based == "auto":
+            zero_based = bool(low == 0)
+        if n_features is None:
+            n_features = max(1, high + 1 if zero_based else high)
+    os.makedirs(path, exist_ok=True)
+    offsets = [0]
+    ys = []
+    for i, start in enumerate(starts):
+        X, y = load_svmlight_file(data_path, n_features=n_features, dtype=dtype,
+                                  zero_based=zero_based, offset=start, length=chunk_bytes)
+        X = scipy.sparse.hstack([X, np.ones(X.shape[0], dtype=dtype).reshape(-1, 1)]).tocsr()
+        _save_chunk(path, i, X)
+        offsets.append(offsets[-1] + X.shape[0])
+        ys.append(y)
+    y = np.concatenate(ys)
+    y[y == -1] = 0
+    y[y == 4] = 0
+    y[y == 2] = 1
+    np.save(os.path.join(path, "offsets.npy"), np.array(offsets))
+    np.save(os.path.join(path, "shape.npy"), np.array([offsets[-1], n_features + 1]))
+    np.save(os.path.join(path, "y.npy"), y.reshape(-1, 1))
+
+
+class StreamingOracle(Oracle):
+    # оракул поверх ChunkedCSR: в памяти только y, векторы длины n и два
+    # блока X; значение + градиент и произведение гессиана на вектор
+    # считаются за один проход по диску
+    sample_space = False
+
+    def __init__(self, path, cache_size=0):
+        X = ChunkedCSR(path)
+        y = np.load(os.path.join(path, "y.npy"))
+        super().__init__(X, y, cache_size=cache_size, dtype=X.dtype)
+
+    def _matvec(self, w):
+        self._count("matvec")
+        w = w.astype(self.dtype, copy=False)
+        z = np.empty((self.vol,) + w.shape[1:])
+        for start, stop, chunk in self.X:
+            z[start:stop] = chunk @ w
+        return z
+
+    def _rmatvec(self, r):
+        self._count("rmatvec")
+        r = r.astype(self.dtype, copy=False)
+        g = np.zeros((self.X.shape[1],) + r.shape[1:])
+        for start, stop, chunk in self.X:
+            g += chunk.T @ r[start:stop]
+        return g
+
+    def _gram_vec(self, weights, v):
+        self._count("matvec")
+        self._count("rmatvec")
+        v = v.astype(self.dtype, copy=False)
+        g = np.zeros((self.X.shape[1],) + v.shape[1:])
+        for start, stop, chunk in self.X:
+            u = weights[start:stop] * (chunk @ v)
+            g += chunk.T @ u.astype(self.dtype, copy=False)
+        return g
+
+    def _gram_diag(self, weights):
+        D = np.zeros((self.X.shape[1],) + weights.shape[1:])
+        for start, stop, chunk in self.X:
+            D += chunk.multiply(chunk).T @ weights[start:stop]
+        return D
+
+    def _hessian(self, p):
+        weights = p * (1 - p) / self.vol
+        H = np.zeros((self.X.shape[1], self.X.shape[1]), order="F")
+        for start, stop, chunk in self.X:
+            H += gram(chunk, weights[start:stop])
+        return H
+
+    def fuse_value_grad(self, w):
+        if self._known(w):
+            return super().fuse_value_grad(w)
+        # один проход: отступы и градиент по каждому блоку
+        self._count("matvec")
+        self._count("rmatvec")
+        self._count("sigmoid")
+        wc = w.astype(self.dtype, copy=False)
+        z = np.empty((self.vol,) + w.shape[1:])
+        g = np.zeros((self.X.shape[1],) + w.shape[1:])
+        for start, stop, chunk in self.X:
+            z[start:stop] = chunk @ wc
+            r = self.y[start:stop] - sigmoid(z[start:stop])
+            g += chunk.T @ r.astype(self.dtype, copy=False)
+        p = sigmoid(z)
+        if self.cache_size > 0:
+            self.cache_misses += 1
+        self._remember(w, (z, p, self.y - p))
+        return self._value(z), - g / self.vol
+
+
+class LineOracle:
+    # phi(a) = f(w + a * d): отступы X @ (w + a * d) = X @ w + a * X @ d,
+    # поэтому после двух умножений на X каждая пробная точка стоит O(n)
+    def __init__(self, oracle, w, d):
+        self.oracle = oracle
+        self.w = w
+        self.d = d
+        self.z, _, _ = oracle._state(w)
+        self.u = oracle._matvec(d)
+        self.last = None
+
+    # a может быть вектором длины K, если w и d - матрицы d x K
+    def _state(self, a):
+        if self.last is not None and np.array_equal(self.last[0], a):
+            return self.last[1]
+        state = self.oracle._link(self.z + a * self.u)
+        self.last = (np.copy(a), state)
+        return state
+
+    # phi(a)
+    def value(self, a):
+        z, _, _ = self._state(a)
+        return self.oracle._value(z)
+
+    # phi'(a) = d.T @ grad(w + a * d)
+    def grad(self, a):
+        _, _, r = self._state(a)
+        return self.oracle._line_grad(self.u, r)
+
+    def fuse_value_grad(self, a):
+        z, _, r = self._state(a)
+        return self.oracle._value(z), self.oracle._line_grad(self.u, r)
+
+    # phi (и phi' при grad=True) сразу для вектора шагов a: отступы
+    # z + a u - матрица n x len(a), без умножений на X
+    def values(self, a, grad=False):
+        a = np.asarray(a, dtype=np.float64).reshape(1, -1)
+        if self.z.shape[1] != 1:
+            # несколько столбцов отступов (SoftmaxOracle, батч W) - по одному шагу
+            out = [self.fuse_value_grad(ak) if grad else (self.value(ak), None) for ak in a[0]]
+            phi = np.array([o[0].item() for o in out])
+            return (phi, np.array([o[1].item() for o in out])) if grad else phi
+        Z = self.z + self.u * a
+        if not grad:
+            return self.oracle._value(Z).reshape(-1)
+        Z, _, R = self.oracle._link(Z)
+        return self.oracle._value(Z).reshape(-1), self.oracle._line_grad(self.u, R).reshape(-1)
+
+    # отдаёт принятую точку и оставляет её отступы оракулу (в кэше или,
+    # без кэша, как последнюю принятую)
+    def accept(self, a):
+        x = self.w + a * self.d
+        self.oracle._remember(x, self._state(a))
+        return x
+
+    # принятая точка вместе со значением и градиентом f в ней: отступы
+    # уже посчитаны, остаётся одно умножение на X.T
+    def fuse_accept(self, a):
+        x = self.accept(a)
+        z, _, r = self._state(a)
+        return x, self.oracle._value(z), self.oracle._grad(r)
+
+
+def make_oracle(data_path, format="libsvm", cache_size=0, dtype=np.float64, num_threads=1,
+                disk_cache=True, disk_cache_dir=None, implicit_intercept=False, multiclass=False):
+    # disk_cache: после первого разбора X и y сохраняются в .npy рядом с
+    # файлом (или в disk_cache_dir), дальше открываются через memmap
+    # implicit_intercept: X без столбца единиц, свободный член считает Oracle
+    # multiclass: метки не сводятся к {0, 1}, возвращается SoftmaxOracle
+    path = None
+    if disk_cache:
+        path = _disk_cache_path(data_path, format, dtype, implicit_intercept, disk_cache_dir,
+                                multiclass)
+    if path is not None and os.path.isdir(path):
+        X, y = _load_disk_cache(path)
+    else:
+        X, y = _read_data(data_path, format, dtype, implicit_intercept, multiclass)
+        if path is not None:
+            try:
+                _save_disk_cache(path, X, y)
+            except OSError:
+                pass
+    cls = SoftmaxOracle if multiclass else Oracle
+    return cls(X, y, cache_size=cache_size, dtype=dtype, num_threads=num_threads,
+               implicit_intercept=implicit_intercept)
+
+def _read_data(data_path, format, dtype, implicit_intercept=False, multiclass=False):
     if format == "libsvm":
-        X, y = load_svmlight_file(data_path)
-        X = scipy.sparse.hstack([X, np.ones(X.shape[0]).reshape(-1, 1)])
-        y[y == -1] = 0
-        y[y == 4] = 0
-        y[y == 2] = 1
+        X, y = load_svmlight_file(data_path, dtype=dtype)
+        if not implicit_intercept:
+            X = scipy.sparse.hstack([X, np.ones(X.shape[0], dtype=dtype).reshape(-1, 1)], format="csr")
+        if not multiclass:
+            y[y == -1] = 0
+            y[y == 4] = 0
+            y[y == 2] = 1
         y = y.reshape(-1, 1)
     elif format == "tsv":
-        data = pd.read_csv("train.tsv", sep='\t').values
+        data = pd.read_csv(data_path, sep='\t').values
         y = data[:, 0].reshape(-1, 1) 
         X = data[:, 1:]
-        X = np.hstack([X, np.ones(X.shape[0]).reshape(-1, 1)])
-    return Oracle(X, y)
+        if not implicit_intercept:
+            X = np.hstack([X, np.ones(X.shape[0]).reshape(-1, 1)])
+        X = X.astype(dtype)
+    return X, y
+
+# ключ кэша: путь, размер и время изменения файла, формат, dtype и
+# наличие столбца единиц, исходные ли метки (multiclass)
+def _disk_cache_path(data_path, format, dtype, implicit_intercept=False, disk_cache_dir=None,
+                     multiclass=False):
+    data_path = os.path.abspath(data_path)
+    stat = os.stat(data_path)
+    key = "%s|%d|%d|%s|%s|%d" % (data_path, stat.st_size, stat.st_mtime_ns, format,
+                                 np.dtype(dtype).str, implicit_intercept)
+    if multiclass:
+        key += "|multiclass"
+    if disk_cache_dir is None:
+        disk_cache_dir = os.path.join(os.path.dirname(data_path), ".oracle_cache")
+    name = "%s-%s" % (os.path.basename(data_path), hashlib.md5(key.encode()).hexdigest()[:16])
+    return os.path.join(disk_cache_dir, name)
+
+def _save_disk_cache(path, X, y):
+    # пишем во временный каталог и переименовываем, чтобы не оставить
+    # недописанный кэш
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    if scipy.sparse.issparse(X):
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(tmp, name + ".npy"), getattr(X, name))
+        np.save(os.path.join(tmp, "shape.npy"), np.array(X.shape))
+    else:
+        np.save(os.path.join(tmp, "X.npy"), np.ascontiguousarray(X))
+    np.save(os.path.join(tmp, "y.npy"), y)
+    os.replace(tmp, path)
+
+def _load_disk_cache(path):
+    load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+    y = load("y")
+    if os.path.exists(os.path.join(path, "X.npy")):
+        return load("X"), y
+    shape = tuple(int(k) for k in load("shape"))
+    X = scipy.sparse.csr_matrix((load("data"), load("indices"), load("indptr")), shape=shape, copy=False)
+    return X, y
 
-def diff_grad(oracle, w):
+# конечные разности сразу по блоку координат: оракул получает матрицу
+# W = w + eps * [e_i, ..., e_j] размера d x block_size и считает все
+# отступы одним умножением X на матрицу
+def _unit_block(w, start, stop, eps):
+    W = np.repeat(w.reshape(-1, 1), stop - start, axis=1)
+    W[np.arange(start, stop), np.arange(stop - start)] += eps
+    return W
+
+def diff_grad(oracle, w, block_size=256):
     f = oracle.value
     eps = 10**(-8)
-    n = oracle.X.shape[1]
+    n = oracle.dim
+    f0 = f(w)
     res = np.zeros(n)
-    for i in range(n):
-        e = np.zeros(n).reshape(-1, 1)
-        e[i] = [1.]
-        res[i] = (f(w + eps * e) - f(w)) / eps
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        res[start:stop] = ((f(_unit_block(w, start, stop, eps)) - f0) / eps).reshape(-1)
     return res.reshape(-1, 1)
 
-def diff_hessian(oracle, w):
+def diff_hessian(oracle, w, block_size=256):
     f = oracle.grad
     eps = 10**(-8)
-    n = oracle.X.shape[1]
-    res = [] 
-    for i in range(n):
-        e = np.zeros(n).reshape(-1, 1)
-        e[i] = [1.]
-        res.append(((f(w + eps * e) - f(w)) / eps).squeeze())
-    return np.array(res)
+    n = oracle.dim
+    g0 = f(w)
+    res = np.zeros((n, n))
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        res[start:stop] = ((f(_unit_block(w, start, stop, eps)) - g0) / eps).T
+    return res
 
-def hess_grad_test(oracle, n=5):
+# проверка по k случайным направлениям V: центральные разности
+# f(w +- eps V) и grad(w +- eps V) против g.T @ V и H @ V за один вызов
+# оракула на матрице d x 2k
+def directional_test(oracle, w, k=10, eps=1e-6):
+    V = np.random.randn(oracle.dim, k)
+    W = np.hstack([w + eps * V, w - eps * V])
+    values, grads = oracle.fuse_value_grad(W)
+    g = oracle.grad(w)
+    err_grad = (values[:, :k] - values[:, k:]) / (2 * eps) - g.T @ V
+    res = [np.max(np.abs(err_grad)), np.max(np.abs(err_grad)) / np.max(np.abs(g.T @ V))]
+    HV = oracle.hessian_operator(w) @ V
+    err_hess = (grads[:, :k] - grads[:, k:]) / (2 * eps) - HV
+    res += [np.max(np.abs(err_hess)), np.max(np.abs(err_hess)) / np.max(np.abs(HV))]
+    return res
+
+def hess_grad_test(oracle, n=5, block_size=256):
     max_err_grad = 0
+    max_rel_err_grad = 0
     max_err_hess = 0
+    max_rel_err_hess = 0
     for i in range(n):
-        w = np.random.rand(oracle.X.shape[1]).reshape(-1, 1)
+        w = np.random.rand(oracle.dim).reshape(-1, 1)
         true_grad = oracle.grad(w)
+        grad = diff_grad(oracle, w, block_size)
+        max_err_grad = max(max_err_grad, np.max(np.abs(grad - true_grad)))
+        max_rel_err_grad = max(max_rel_err_grad, np.max(np.abs(grad - true_grad)) / np.max(np.abs(true_grad)))
         true_hessian = oracle.hessian(w)
-        grad = diff_grad(oracle, w)
-        hess = diff_hessian(oracle, w)
-        max_err_grad = max(max_err_grad, np.max(grad - true_grad))
-        max_err_hess = max(max_err_hess, np.max(hess - true_hessian))
+        hess = diff_hessian(oracle, w, block_size)
+        max_err_hess = max(max_err_hess, np.max(np.abs(hess - true_hessian)))
+        max_rel_err_hess = max(max_rel_err_hess, np.max(np.abs(hess - true_hessian)) / np.max(np.abs(true_hessian)))
     print("Максимальное значение ошибки приближения градиента: ", max_err_grad)
-    print("Максимальное значение ошибки приближения гессиана: ", max_err_hess)
\ No newline at end of file
+    print("Максимальная относительная ошибка приближения градиента: ", max_rel_err_grad)
+    print("Максимальное значение ошибки приближения гессиана: ", max_err_hess)
+    print("Максимальная относительная ошибка приближения гессиана: ", max_rel_err_hess)
+
+def directional_grad_test(oracle, n=5, k=10):
+    res = np.zeros(4)
+    for i in range(n):
+        w = np.random.rand(oracle.dim).reshape(-1, 1)
+        res = np.maximum(res, directional_test(oracle, w, k))
+    print("Максимальное значение ошибки градиента по направлениям: ", res[0])
+    print("Максимальная относительная ошибка градиента по направлениям: ", res[1])
+    print("Максимальное значение ошибки гессиана по направлениям: ", res[2])
+    print("Максимальная относительная ошибка гессиана по направлениям: ", res[3])
@@ -2,33 +2,148 @@
 
 import numpy as np
 import scipy
-from time import time
-
-class optimize_gd:
-    def __init__(self):
-        self.values = []
-        self.iterations = []
-        self.oracle_calls = []
-        self.times = []
-        self.grads = []
-    
-    def __call__(self, oracle, start_point, line_search_method, tol=1e-8, max_iter=10000):
-        x = start_point
+from time import perf_counter
+
+
+class TraceRecorder:
+    # трасса оптимизатора в заранее выделенных столбцах numpy (при
+    # заполнении ёмкость удваивается): iterations, values, grads,
+    # oracle_calls, steps, times и любые столбцы, переданные в record;
+    # every - писать каждую every-ю итерацию (последняя дописывается в finish),
+    # callback(recorder, k) - после каждой записи, log_every - печать не чаще
+    # раза в log_every секунд; время callback и печати в times не входит
+    def __init__(self, every=1, callback=None, log_every=None, capacity=256):
+        self.every = every
+        self.callback = callback
+        self.log_every = log_every
+        self.capacity = capacity
+        self.start()
+
+    def start(self):
+        self.columns = {}
+        self.n = 0
+        self.pending = None
+        self.paused = 0.
+        self.last_log = -np.inf
+        self.time0 = perf_counter()
+
+    def elapsed(self):
+        return perf_counter() - self.time0 - self.paused
+
+    def record(self, k, value, grad, oracle_calls, step=np.nan, **extra):
+        row = dict(iterations=k, values=value, grads=grad, oracle_calls=oracle_calls,
+                   steps=step, times=self.elapsed(), **extra)
+        if k % self.every:
+            self.pending = row
+        else:
+            self._write(row)
+
+    def finish(self):
+        if self.pending is not None:
+            self._write(self.pending)
+
+    def _write(self, row):
+        self.pending = None
+        if self.n == self.capacity:
+            self.capacity *= 2
+            for name, col in self.columns.items():
+                new = np.zeros((self.capacity,) + col.shape[1:], dtype=col.dtype)
+                new[:self.n] = col[:self.n]
+                self.columns[name] = new
+        for name, value in row.items():
+            col = self.columns.get(name)
+            if col is None:
+                value = np.asarray(value)
+                dtype = value.dtype if value.dtype.kind in "iub" else np.float64
+                # столбец, появившийся позже (например, новый счётчик), - нули до него
+                col = self.columns[name] = np.zeros((self.capacity,) + value.shape, dtype=dtype)
+            col[self.n] = value
+        self.n += 1
+
+        if self.callback is None and self.log_every is None:
+            return
+        t = perf_counter()
+        if self.callback is not None:
+            self.callback(self, row["iterations"])
+        if self.log_every is not None and t - self.last_log >= self.log_every:
+            self.last_log = t
+            print("iteration {}: value {}, grad {}, oracle calls {}".format(
+                row["iterations"], np.squeeze(row["values"]), np.squeeze(row["grads"]),
+                row["oracle_calls"]))
+        self.paused += perf_counter() - t
+
+    # пустой массив, если столбца нет (метод ещё не запускался или его не пишет)
+    def column(self, name):
+        col = self.columns.get(name)
+        return np.empty(0) if col is None else col[:self.n]
+
+    def as_dict(self):
+        return {name: self.column(name) for name in self.columns}
+
+    def export(self, path):
+        np.savez(path, **self.as_dict())
+
+    # значения в старом формате - массив k x 1 x 1, как список 1 x 1 матриц,
+    # чтобы six_plots и one_plot работали без изменений
+    @property
+    def values(self):
+        col = self.column("values")
+        return col.reshape(-1, 1, 1) if col.ndim == 1 else col
+
+
+class Traced:
+    # общая часть оптимизаторов: трасса в self.trace, старые атрибуты
+    # values, iterations, oracle_calls, times, grads - её столбцы
+    def __init__(self, every=1, callback=None, log_every=None):
+        self.trace = TraceRecorder(every, callback, log_every)
+
+    values = property(lambda self: self.trace.values)
+    iterations = property(lambda self: self.trace.column("iterations"))
+    oracle_calls = property(lambda self: self.trace.column("oracle_calls"))
+    times = property(lambda self: self.trace.column("times"))
+    grads = property(lambda self: self.trace.column("grads"))
+    steps = property(lambda self: self.trace.column("steps"))
+    direction_times = property(lambda self: self.trace.column("direction_times"))
+    line_search_times = property(lambda self: self.trace.column("line_search_times"))
+    oracle_times = property(lambda self: self.trace.column("oracle_times"))
+
+
+# время фаз итерации и счётчики оракула (столбцы count_<имя>) для record
+def _phases(oracle, t_direction, t_line_search, t_oracle):
+    extra = dict(direction_times=t_direction, line_search_times=t_line_search,
+                 oracle_times=t_oracle)
+    if oracle.stats is not None:
+        extra.update(("count_" + key, value) for key, value in oracle.stats.items())
+    return extra
+
+# все трассы метода словарём массивов, при path - ещё и в .npz
+def export_traces(method, path=None):
+    if path is not None:
+        method.trace.export(path)
+    return method.trace.as_dict()
+
+
+class optimize_gd(Traced):
+    def __call__(self, oracle, start_point, line_search_method, tol=1e-8, max_iter=10000,
+                 stochastic=False):
+        # состояние метода всегда в float64, даже если оракул считает в float32
+        x = np.asarray(start_point, dtype=np.float64)
 
         oracle_call = 0
 
-        v, g = oracle.fuse_value_grad(x)
+        # stochastic: шаг по мини-батчу StochasticOracle, line search - по нему же
+        f = oracle.batch() if stochastic else oracle
+
+        self.trace.start()
+        t = perf_counter()
+        v, g = f.fuse_value_grad(x)
         oracle_call += 1
+        t_oracle = perf_counter() - t
         d = -g
         d_start = d
         iter_num = 0
-        time0 = time()
 
-        self.values.append(v)
-        self.iterations.append(iter_num)
-        self.oracle_calls.append(oracle_call)
-        self.times.append(0)
-        self.grads.append(1)
+        self.trace.record(iter_num, v.item(), 1., oracle_call, **_phases(oracle, 0, 0, t_oracle))
 
         norm_d_start_sq = d_start.T @ d_start
         # print("norm(d_0)^2: ", norm_d_start_sq[0][0])
@@ -39,26 +154,293 @@ class optimize_gd:
                 print("break")
                 break
 
-            alpha, oraclecalls = line_search_method(oracle, x, d, stata=True)
+            # line search, отдающий значение и градиент в новой точке, экономит
+            # вызов оракула (кроме стохастического режима - там новый батч)
+            reuse = getattr(line_search_method, "returns_value_grad", False) and not stochastic
+            t = perf_counter()
+            if reuse:
+                alpha, oraclecalls, v, g = line_search_method(f, x, d, stata=True, full_output=True)
+            else:
+                alpha, oraclecalls = line_search_method(f, x, d, stata=True)
             oracle_call += oraclecalls
+            t_line_search = perf_counter() - t
 
             x = x + alpha * d
-            v, g = oracle.fuse_value_grad(x)
-            oracle_call += 1
+            if stochastic:
+                oracle.next_batch()
+                f = oracle.batch()
+            t = perf_counter()
+            if not reuse:
+                v, g = f.fuse_value_grad(x)
+                oracle_call += 1
+            t_oracle = perf_counter() - t
+            t = perf_counter()
             d = -g
+            t_direction = perf_counter() - t
+
+            self.trace.record(iter_num, v.item(), (d.T @ d / norm_d_start_sq).item(), oracle_call,
+                              np.asarray(alpha).item(),
+                              **_phases(oracle, t_direction, t_line_search, t_oracle))
+
+        self.trace.finish()
+        return x
+
+
+class optimize_gd_batch(Traced):
+    # K запусков GD как одна матричная задача: W = [w_1, ..., w_K] размера
+    # d x K, значения и градиенты всех столбцов - один проход по X; шаг
+    # Армихо у каждого столбца свой, сошедшиеся столбцы больше не двигаются
+    def __call__(self, oracle, start_points, tol=1e-8, max_iter=10000, c1=1e-4, eta=2.):
+        W = np.array(start_points, dtype=np.float64)
+        K = W.shape[1]
+
+        oracle_call = 0
+
+        self.trace.start()
+        v, G = oracle.fuse_value_grad(W)
+        oracle_call += 1
+        v = v.reshape(-1)
+        norm_start = np.sum(G * G, axis=0)
+        norm = norm_start
+        active = norm > tol * norm_start
+        alpha = np.ones(K)
+        iter_num = 0
+
+        self.trace.record(iter_num, v, np.ones(K), oracle_call, np.zeros(K))
+
+        while active.any():
+            iter_num += 1
+            if iter_num >= max_iter:
+                print("break")
+                break
+
+            line = oracle.line(W, -G * active)
+            # бэктрекинг по каждому столбцу, начиная с увеличенного прошлого шага;
+            # у сошедшихся направление нулевое, их шаг не трогаем - иначе он
+            # растёт до inf и inf * 0 портит столбец
+            alpha = np.where(active, alpha * eta, alpha)
+            bad = active
+            for _ in range(100):
+                phi = line.value(alpha).reshape(-1)
+                oracle_call += 1
+                bad = active & (phi > v - c1 * alpha * norm)
+                if not bad.any():
+                    break
+                alpha[bad] /= eta
+
+            W = line.accept(alpha)
+            v, G = oracle.fuse_value_grad(W)
+            oracle_call += 1
+            v = v.reshape(-1)
+            norm = np.sum(G * G, axis=0)
+            active = active & (norm > tol * norm_start)
 
+            self.trace.record(iter_num, v, norm / norm_start, oracle_call, alpha)
+
+        self.trace.finish()
+        return W
+
+# optimize_gd_batch из K точек: первая - уже найденный минимум, для неё
+# относительный критерий недостижим и запуск идёт до max_iter, а остальные
+# (случайные) сходятся и тысячи итераций стоят замороженными; все столбцы
+# должны остаться конечными, остальные - сойтись к тому же значению
+def gd_batch_test(oracle, K=3, tol=1e-8, max_iter=10000):
+    W = np.random.randn(oracle.dim, K)
+    W[:, :1] = optimize_gd_batch()(oracle, np.zeros((oracle.dim, 1)), tol, max_iter)
+    method = optimize_gd_batch()
+    W = method(oracle, W, tol, max_iter)
+    values = oracle.value(W).reshape(-1)
+    res = [np.sum(~np.isfinite(W)), np.max(method.grads[-1][1:]), np.max(values) - np.min(values)]
+    print("Нечисловых координат: ", res[0])
+    print("Максимальная относительная норма градиента: ", res[1])
+    print("Разброс значений по столбцам: ", res[2])
+    return res
+
+
+def arg_min_prox(x, a, lam):
+    # prox для lam * ||w||_1 с шагом a; a и lam могут быть векторами длины K
+    return np.sign(x) * np.maximum(np.abs(x) - lam * a, 0)
+
+
+class optimize_lasso_batch(Traced):
+    # проксимальный градиентный метод сразу для K задач: столбцы W - разные
+    # lam и/или стартовые точки, L (константа Липшица) у каждого столбца своя
+    non_zero = property(lambda self: self.trace.column("non_zero"))
+
+    def __call__(self, oracle, start_points, lams, tol=1e-8, max_iter=10000):
+        W = np.array(start_points, dtype=np.float64)
+        K = W.shape[1]
+        if W.shape[1] == 1 and np.size(lams) > 1:
+            W = np.repeat(W, np.size(lams), axis=1)
+            K = W.shape[1]
+        lam = np.broadcast_to(np.asarray(lams, dtype=np.float64), (K,))
+        L = np.ones(K)
+        active = np.ones(K, dtype=bool)
+
+        oracle_call = 0
+        self.trace.start()
+
+        for k in range(max_iter):
+            value_f0, grad_f0 = oracle.fuse_value_grad(W)
+            oracle_call += 1
+            value_f0 = value_f0.reshape(-1)
+            a = 1 / L
+            Y = arg_min_prox(W - a * grad_f0, a, lam)
+            value_f = oracle.value(Y).reshape(-1)
+            oracle_call += 1
+
+            while True:
+                S = Y - W
+                bad = active & (value_f > value_f0 + np.sum(grad_f0 * S, axis=0) + np.sum(S * S, axis=0) * L / 2)
+                if not bad.any():
+                    break
+                L[bad] *= 2
+                a = 1 / L
+                Y = arg_min_prox(W - a * grad_f0, a, lam)
+                value_f = oracle.value(Y).reshape(-1)
+                oracle_call += 1
+
+            gradF = (W - Y) * L
+            norm = np.sum(gradF * gradF, axis=0)
+            L[active] /= 2
+            W[:, active] = Y[:, active]
+
+            # у замороженных столбцов W не менялся: f(W) = value_f0, а не f(Y)
+            # отклонённого шага
+            value_W = np.where(active, value_f, value_f0)
+            self.trace.record(k + 1, value_W + lam * np.sum(np.abs(W), axis=0), norm, oracle_call,
+                              1 / L, non_zero=np.sum(W != 0, axis=0))
+
+            active = active & (norm > tol)
+            if not active.any():
+                break
+
+        self.trace.finish()
+        return W
+
+
+class LBFGSHistory:
+    # последние size пар (s, y) - строки кольцевых буферов size x dim,
+    # head - куда пишется следующая пара; в двухпетлевой рекурсии каждое
+    # произведение - скалярное произведение со сплошной строкой буфера
+    def __init__(self, size, dim):
+        self.size = size
+        self.S = np.empty((size, dim))
+        self.Y = np.empty((size, dim))
+        self.rho = np.empty(size)
+        self.reset()
+
+    def reset(self):
+        self.head = 0
+        self.count = 0
+
+    # пара с s.T @ y <= 0 не сохраняется: приближение обратного гессиана
+    # перестало бы быть положительно определённым
+    def push(self, s, y):
+        s = s.reshape(-1)
+        y = y.reshape(-1)
+        sy = s @ y
+        if sy <= 1e-10 * (y @ y):
+            return False
+        self.S[self.head] = s
+        self.Y[self.head] = y
+        self.rho[self.head] = 1 / sy
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        return True
+
+    # H @ g, H0 = gamma I, gamma = s.T @ y / y.T @ y последней пары
+    def apply(self, g):
+        q = np.array(g, dtype=np.float64).reshape(-1)
+        if self.count == 0:
+            return q.reshape(g.shape)
+        # от новых пар к старым
+        order = (self.head - 1 - np.arange(self.count)) % self.size
+        alpha = np.empty(self.count)
+        for j, i in enumerate(order):
+            alpha[j] = self.rho[i] * (self.S[i] @ q)
+            q -= alpha[j] * self.Y[i]
+        last = order[0]
+        q *= 1 / (self.rho[last] * (self.Y[last] @ self.Y[last]))
+        for j in range(self.count - 1, -1, -1):
+            i = order[j]
+            beta = self.rho[i] * (self.Y[i] @ q)
+            q += (alpha[j] - beta) * self.S[i]
+        return q.reshape(g.shape)
+
+
+# псевдоградиент f(w) + lam ||w||_1: в нуле - наименьшая по модулю
+# производная по направлению, 0 если 0 входит в субдифференциал
+def pseudo_grad(w, g, lam):
+    pg = np.where(w > 0, g + lam, np.where(w < 0, g - lam, 0.))
+    zero = w == 0
+    pg[zero & (g + lam < 0)] = (g + lam)[zero & (g + lam < 0)]
+    pg[zero & (g - lam > 0)] = (g - lam)[zero & (g - lam > 0)]
+    return pg
+
+
+class optimize_owlqn(Traced):
+    # OWL-QN (Andrew, Gao): L-BFGS по гладкой части, направление - по
+    # псевдоградиенту, обрезанное до его знаков; line search - бэктрекинг с
+    # проекцией на ортант (знаки w, в нуле - знаки -псевдоградиента)
+    non_zero = property(lambda self: self.trace.column("non_zero"))
+
+    def __call__(self, oracle, start_point, lam, tol=1e-8, history_size=10, max_iter=1000,
+                 c1=1e-4, eta=0.5, max_backtracks=50):
+        x = np.array(start_point, dtype=np.float64)
+
+        oracle_call = 0
+        self.memory = LBFGSHistory(history_size, x.size)
+
+        self.trace.start()
+        t = perf_counter()
+        v, g = oracle.fuse_value_grad(x)
+        oracle_call += 1
+        t_oracle = perf_counter() - t
+        F = v.item() + lam * np.sum(np.abs(x))
+        pg = pseudo_grad(x, g, lam)
+        norm = (pg.T @ pg).item()
+
+        self.trace.record(0, F, norm, oracle_call, non_zero=np.sum(x != 0),
+                          **_phases(oracle, 0, 0, t_oracle))
+
+        for k in range(1, max_iter):
+            if norm <= tol:
+                break
+
+            t = perf_counter()
+            d = -self.memory.apply(pg)
+            d[d * pg >= 0] = 0
+            if (pg.T @ d).item() >= 0:
+                self.memory.reset()
+                d = -pg
+            orthant = np.where(x != 0, np.sign(x), -np.sign(pg))
+            t_direction = perf_counter() - t
+
+            # первый шаг по антиградиенту - длины 1
+            t = perf_counter()
+            alpha = 1. if self.memory.count else 1 / norm ** 0.5
+            for _ in range(max_backtracks):
+                x_new = x + alpha * d
+                x_new[x_new * orthant <= 0] = 0
+                v_new, g_new = oracle.fuse_value_grad(x_new)
+                oracle_call += 1
+                F_new = v_new.item() + lam * np.sum(np.abs(x_new))
+                if F_new <= F + c1 * (pg.T @ (x_new - x)).item():
+                    break
+                alpha *= eta
+            else:
+                print("break")
+                break
+            t_line_search = perf_counter() - t
 
-            if iter_num % 1000 == 0:
-                print('iteration: {}'.format(iter_num))
-                print('value of CE: {}'.format(v[0][0]))
-                print('norm(d)^2 / norm(d_0)^2:', (d.T @ d / norm_d_start_sq)[0][0])
-                print('alpha', alpha.squeeze())
-                print()
+            self.memory.push(x_new - x, g_new - g)
+            x, g, F = x_new, g_new, F_new
+            pg = pseudo_grad(x, g, lam)
+            norm = (pg.T @ pg).item()
 
-            self.values.append(v)
-            self.iterations.append(iter_num)
-            self.oracle_calls.append(oracle_call)
-            self.times.append(time() - time0)
-            self.grads.append((d.T @ d / norm_d_start_sq)[0][0])
+            self.trace.record(k, F, norm, oracle_call, alpha, non_zero=np.sum(x != 0),
+                              **_phases(oracle, t_direction, t_line_search, 0))
 
-        return x
\ No newline at end of file
+        self.trace.finish()
+        return x
@@ -1,83 +1,519 @@
 #!/usr/bin/env python
 
+import hashlib
+import os
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from scipy.special import expit as sigmoid
+from scipy.special import logsumexp, softmax
 import numpy as np
 import pandas as pd
 import scipy
 from sklearn.datasets import load_svmlight_file
 
 class Oracle:
-    def __init__(self, X, y):
+    def __init__(self, X, y, cache_size=0, dtype=np.float64, num_threads=1,
+                 implicit_intercept=False):
+        # CSR: быстрые умножения и срезы по строкам
+        if scipy.sparse.issparse(X) and X.format != "csr":
+            X = X.tocsr()
+        # X хранится в dtype (например, float32), а отступы, значение и
+        # градиент приводятся к float64
+        self.dtype = np.dtype(dtype)
+        if X.dtype != self.dtype:
+            X = X.astype(self.dtype)
         self.X = X
         self.y = y
         self.vol = len(y)
-    
+
+        # implicit_intercept: столбца единиц в X нет, свободный член - последняя
+        # координата w, X @ w[:-1] + w[-1]; размерность w - self.dim
+        self.implicit_intercept = implicit_intercept
+        self.dim = X.shape[1] + int(implicit_intercept)
+
+        # num_threads > 1: X режется на num_threads блоков строк, умножения
+        # по блокам идут в пуле потоков (scipy и numpy отпускают GIL),
+        # частичные градиенты складываются всегда в одном порядке
+        self.num_threads = num_threads
+        if num_threads > 1:
+            bounds = np.linspace(0, X.shape[0], num_threads + 1).astype(int)
+            self.shards = [(start, stop, row_slice(X, start, stop))
+                           for start, stop in zip(bounds[:-1], bounds[1:])]
+            self.pool = ThreadPoolExecutor(num_threads)
+            # потоки пула останавливаются по close() или вместе с оракулом
+            self._shutdown = weakref.finalize(self, self.pool.shutdown, wait=False)
+
+        # LRU-кэш: точка w -> (X @ w, sigmoid(X @ w), y - sigmoid(X @ w))
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # без кэша - состояние последней принятой line search точки: следующий
+        # вызов оракула в ней (и line search из неё) не умножает на X заново
+        self._accepted = None
+
+        # счётчики умножений на X / X.T, вычислений sigmoid, построений
+        # гессиана и разложений Холецкого; None - выключены
+        self.stats = None
+
+    def instrument(self, enable=True):
+        self.stats = Counter() if enable else None
+        return self
+
+    def _count(self, key, k=1):
+        if self.stats is not None:
+            self.stats[key] += k
+
+    def _state(self, w):
+        if self.cache_size <= 0:
+            if self._accepted is not None and np.array_equal(self._accepted[0], w):
+                return self._accepted[1]
+            return self._compute_state(w)
+        key = (w.shape, w.dtype.str, w.tobytes())
+        state = self.cache.get(key)
+        if state is not None:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return state
+        self.cache_misses += 1
+        state = self._compute_state(w)
+        self._store(key, state)
+        return state
+
+    def _store(self, key, state):
+        self.cache[key] = state
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _remember(self, w, state):
+        if self.cache_size > 0:
+            self._store((w.shape, w.dtype.str, w.tobytes()), state)
+        else:
+            self._accepted = (np.copy(w), state)
+
+    # состояние в w уже посчитано (в кэше или принятая точка)
+    def _known(self, w):
+        if self.cache_size > 0:
+            return (w.shape, w.dtype.str, w.tobytes()) in self.cache
+        return self._accepted is not None and np.array_equal(self._accepted[0], w)
+
+    def _matvec(self, w):
+        self._count("matvec")
+        if self.implicit_intercept:
+            b = w[-1:].astype(np.float64)
+            w = w[:-1]
+        w = w.astype(self.dtype, copy=False)
+        if self.num_threads > 1:
+            z = np.concatenate(list(self.pool.map(lambda shard: shard[2] @ w, self.shards)))
+        else:
+            z = self.X @ w
+        z = z.astype(np.float64, copy=False)
+        if self.implicit_intercept:
+            z += b
+        return z
+
+    def _rmatvec(self, r):
+        self._count("rmatvec")
+        rc = r.astype(self.dtype, copy=False)
+        if self.num_threads > 1:
+            parts = self.pool.map(lambda shard: shard[2].T @ rc[shard[0]:shard[1]], self.shards)
+            g = None
+            for part in parts:
+                g = part.astype(np.float64) if g is None else g + part
+        else:
+            g = (self.X.T @ rc).astype(np.float64, copy=False)
+        if self.implicit_intercept:
+            # производная по свободному члену - сумма остатков
+            g = np.concatenate([g, r.sum(axis=0, keepdims=True)])
+        return g
+
+    def _compute_state(self, w):
+        return self._link(self._matvec(w))
+
+    # отступы -> (z, вероятности, остатки)
+    def _link(self, z):
+        self._count("sigmoid")
+        p = sigmoid(z)
+        return z, p, self.y - p
+
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "size": len(self.cache), "max_size": self.cache_size}
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._accepted = None
+
+    def close(self):
+        if self.num_threads > 1:
+            self._shutdown()
+
+    # -y log(sigmoid(z)) - (1 - y) log(1 - sigmoid(z)) = log(1 + e^z) - y z,
+    # logaddexp не переполняется и не требует сдвига delta
+    def _value(self, z):
+        return (np.logaddexp(0, z).sum(axis=0) - self.y.T @ z) / self.vol
+
+    def _grad(self, r):
+        return - self._rmatvec(r) / self.vol
+
+    # производная вдоль направления d, u = X @ d
+    def _line_grad(self, u, r):
+        return - u.T @ r / self.vol
+
     # скаляр
     def value(self, w): 
-        delta = 10 ** (-8)
-        p = sigmoid(self.X @ w)
-        return -(self.y.T @ np.log(p + delta) + (1 - self.y).T @ np.log(1 - p + delta)) / self.vol
+        z, _, _ = self._state(w)
+        return self._value(z)
 
     # вектор
     def grad(self, w):
-        p = sigmoid(self.X @ w)
-        return - self.X.T @ (self.y - p) / self.vol
+        _, _, r = self._state(w)
+        return self._grad(r)
 
     # матрица
     def fuse_value_grad(self, w):
-        return self.value(w), self.grad(w)
+        z, _, r = self._state(w)
+        return self._value(z), self._grad(r)
+
+    def line(self, w, d):
+        return LineOracle(self, w, d)
     
     def value_with_reg(self, w, lam):
         return self.value(w) + lam * np.sum(np.abs(w))
 
 
-def make_oracle(data_path, format="libsvm"):
+def row_slice(X, start, stop):
+    # срез строк CSR без копирования data и indices
+    if not scipy.sparse.issparse(X):
+        return X[start:stop]
+    indptr = X.indptr[start:stop + 1]
+    return scipy.sparse.csr_matrix(
+        (X.data[indptr[0]:indptr[-1]], X.indices[indptr[0]:indptr[-1]], indptr - indptr[0]),
+        shape=(stop - start, X.shape[1]), copy=False)
+
+
+class StochasticOracle(Oracle):
+    # строки перемешиваются один раз при создании, поэтому мини-батч -
+    # это непрерывный срез строк, а эпоха - один последовательный проход по X
+    def __init__(self, X, y, batch_size=256, growth=1., seed=None, **kwargs):
+        if scipy.sparse.issparse(X):
+            X = X.tocsr()
+        perm = np.random.RandomState(seed).permutation(len(y))
+        super().__init__(X[perm], y[perm], **kwargs)
+        self.batch_size = batch_size
+        # после каждого шага размер батча умножается на growth
+        self.growth = growth
+        self.start = 0
+        self.epoch = 0
+        self._batch = None
+
+    def batch(self):
+        if self._batch is None:
+            stop = self.start + int(self.batch_size)
+            if stop <= self.vol:
+                X, y = row_slice(self.X, self.start, stop), self.y[self.start:stop]
+            else:
+                # хвост эпохи дополняется строками из начала следующей, чтобы
+                # размер батча шёл по расписанию
+                stop -= self.vol
+                parts = [row_slice(self.X, self.start, self.vol), row_slice(self.X, 0, stop)]
+                X = (scipy.sparse.vstack(parts, format="csr") if scipy.sparse.issparse(self.X)
+                     else np.vstack(parts))
+                y = np.concatenate([self.y[self.start:], self.y[:stop]])
+            self._batch = Oracle(X, y, cache_size=self.cache_size, dtype=self.dtype,
+                                 num_threads=self.num_threads,
+                                 implicit_intercept=self.implicit_intercept)
+            # счётчики батчей копятся в общем Counter
+            self._batch.stats = self.stats
+        return self._batch
+
+    def next_batch(self):
+        self.start += int(self.batch_size)
+        if self.start >= self.vol:
+            self.start -= self.vol
+            self.epoch += 1
+        self.batch_size = min(self.vol, self.batch_size * self.growth)
+        self._close_batch()
+
+    def _close_batch(self):
+        if self._batch is not None:
+            self._batch.close()
+        self._batch = None
+
+    def close(self):
+        self._close_batch()
+        super().close()
+
+    def value_batch(self, w):
+        return self.batch().value(w)
+
+    def grad_batch(self, w):
+        return self.batch().grad(w)
+
+    def fuse_value_grad_batch(self, w):
+        return self.batch().fuse_value_grad(w)
+
+
+class SoftmaxOracle(Oracle):
+    # мультиномиальная логистическая регрессия: веса - матрица m x C
+    # (m = X.shape[1] + свободный член), хранится столбцом w = W.reshape(-1, 1, order="F"),
+    # так что оптимизаторы и line search работают с ней как с обычным вектором;
+    # отступы всех классов - одно умножение X @ W; блок из K точек (dim x K)
+    # даёт отступы n x C x K, значения 1 x K и градиенты dim x K
+    def __init__(self, X, y, **kwargs):
+        self.classes, labels = np.unique(np.asarray(y).reshape(-1), return_inverse=True)
+        self.n_classes = len(self.classes)
+        Y = np.zeros((len(labels), self.n_classes))
+        Y[np.arange(len(labels)), labels] = 1
+        super().__init__(X, Y, **kwargs)
+        self.n_features = self.dim
+        self.dim = self.n_features * self.n_classes
+
+    def unpack(self, w):
+        return w.reshape((self.n_features, self.n_classes), order="F")
+
+    def pack(self, W):
+        return W.reshape(-1, 1, order="F")
+
+    # K точек - одно умножение X на m x (C K)
+    def _matvec(self, w):
+        K = w.shape[1] if w.ndim == 2 else 1
+        if K == 1:
+            return super()._matvec(self.unpack(w))
+        z = super()._matvec(w.reshape((self.n_features, self.n_classes * K), order="F"))
+        return z.reshape((self.vol, self.n_classes, K), order="F")
+
+    def _rmatvec(self, r):
+        if r.ndim < 3:
+            return self.pack(super()._rmatvec(r))
+        g = super()._rmatvec(r.reshape((self.vol, -1), order="F"))
+        return g.reshape((self.dim, r.shape[2]), order="F")
+
+    # метки под форму отступов: n x C или n x C x 1
+    def _labels(self, z):
+        return self.y if z.ndim == 2 else self.y[:, :, None]
+
+    def _link(self, z):
+        self._count("softmax")
+        p = softmax(z, axis=1)
+        return z, p, self._labels(z) - p
+
+    # sum_i (logsumexp(z_i) - z_{i, y_i}) / n
+    def _value(self, z):
+        return ((logsumexp(z, axis=1).sum(axis=0) - np.sum(self._labels(z) * z, axis=(0, 1)))
+                / self.vol).reshape(1, -1)
+
+    def _line_grad(self, u, r):
+        return (- np.sum(u * r, axis=(0, 1)) / self.vol).reshape(1, -1)
+
+
+class LineOracle:
+    # phi(a) = f(w + a * d): отступы X @ (w + a * d) = X @ w + a * X @ d,
+    # поэтому после двух умножений на X каждая пробная точка стоит O(n)
+    def __init__(self, oracle, w, d):
+        self.oracle = oracle
+        self.w = w
+        self.d = d
+        self.z, _, _ = oracle._state(w)
+        self.u = oracle._matvec(d)
+        self.last = None
+
+    # a может быть вектором длины K, если w и d - матрицы d x K
+    def _state(self, a):
+        if self.last is not None and np.array_equal(self.last[0], a):
+            return self.last[1]
+        state = self.oracle._link(self.z + a * self.u)
+        self.last = (np.copy(a), state)
+        return state
+
+    # phi(a)
+    def value(self, a):
+        z, _, _ = self._state(a)
+        return self.oracle._value(z)
+
+    # phi'(a) = d.T @ grad(w + a * d)
+    def grad(self, a):
+        _, _, r = self._state(a)
+        return self.oracle._line_grad(self.u, r)
+
+    def fuse_value_grad(self, a):
+        z, _, r = self._state(a)
+        return self.oracle._value(z), self.oracle._line_grad(self.u, r)
+
+    # phi (и phi' при grad=True) сразу для вектора шагов a: отступы
+    # z + a u - матрица n x len(a), без умножений на X
+    def values(self, a, grad=False):
+        a = np.asarray(a, dtype=np.float64).reshape(1, -1)
+        if self.z.shape[1] != 1:
+            # несколько столбцов отступов (SoftmaxOracle, батч W) - по одному шагу
+            out = [self.fuse_value_grad(ak) if grad else (self.value(ak), None) for ak in a[0]]
+            phi = np.array([o[0].item() for o in out])
+            return (phi, np.array([o[1].item() for o in out])) if grad else phi
+        Z = self.z + self.u * a
+        if not grad:
+            return self.oracle._value(Z).reshape(-1)
+        Z, _, R = self.oracle._link(Z)
+        return self.oracle._value(Z).reshape(-1), self.oracle._line_grad(self.u, R).reshape(-1)
+
+    # отдаёт принятую точку и оставляет её отступы оракулу (в кэше или,
+    # без кэша, как последнюю принятую)
+    def accept(self, a):
+        x = self.w + a * self.d
+        self.oracle._remember(x, self._state(a))
+        return x
+
+    # принятая точка вместе со значением и градиентом f в ней: отступы
+    # уже посчитаны, остаётся одно умножение на X.T
+    def fuse_accept(self, a):
+        x = self.accept(a)
+        z, _, r = self._state(a)
+        return x, self.oracle._value(z), self.oracle._grad(r)
+
+
+def make_oracle(data_path, format="libsvm", cache_size=0, dtype=np.float64, num_threads=1,
+                disk_cache=True, disk_cache_dir=None, implicit_intercept=False, multiclass=False):
+    # disk_cache: после первого разбора X и y сохраняются в .npy рядом с
+    # файлом (или в disk_cache_dir), дальше открываются через memmap
+    # implicit_intercept: X без столбца единиц, свободный член считает Oracle
+    # multiclass: метки не сводятся к {0, 1}, возвращается SoftmaxOracle
+    path = None
+    if disk_cache:
+        path = _disk_cache_path(data_path, format, dtype, implicit_intercept, disk_cache_dir,
+                                multiclass)
+    if path is not None and os.path.isdir(path):
+        X, y = _load_disk_cache(path)
+    else:
+        X, y = _read_data(data_path, format, dtype, implicit_intercept, multiclass)
+        if path is not None:
+            try:
+                _save_disk_cache(path, X, y)
+            except OSError:
+                pass
+    cls = SoftmaxOracle if multiclass else Oracle
+    return cls(X, y, cache_size=cache_size, dtype=dtype, num_threads=num_threads,
+               implicit_intercept=implicit_intercept)
+
+def _read_data(data_path, format, dtype, implicit_intercept=False, multiclass=False):
     if format == "libsvm":
-        X, y = load_svmlight_file(data_path)
-        X = scipy.sparse.hstack([X, np.ones(X.shape[0]).reshape(-1, 1)])
-        y[y == -1] = 0
-        y[y == 4] = 0
-        y[y == 2] = 1
+        X, y = load_svmlight_file(data_path, dtype=dtype)
+        if not implicit_intercept:
+            X = scipy.sparse.hstack([X, np.ones(X.shape[0], dtype=dtype).reshape(-1, 1)], format="csr")
+        if not multiclass:
+            y[y == -1] = 0
+            y[y == 4] = 0
+            y[y == 2] = 1
         y = y.reshape(-1, 1)
     elif format == "tsv":
-        data = pd.read_csv("train.tsv", sep='\t').values
+        data = pd.read_csv(data_path, sep='\t').values
         y = data[:, 0].reshape(-1, 1) 
         X = data[:, 1:]
-        X = np.hstack([X, np.ones(X.shape[0]).reshape(-1, 1)])
-    return Oracle(X, y)
+        if not implicit_intercept:
+            X = np.hstack([X, np.ones(X.shape[0]).reshape(-1, 1)])
+        X = X.astype(dtype)
+    return X, y
+
+# ключ кэша: путь, размер и время изменения файла, формат, dtype и
+# наличие столбца единиц, исходные ли метки (multiclass)
+def _disk_cache_path(data_path, format, dtype, implicit_intercept=False, disk_cache_dir=None,
+                     multiclass=False):
+    data_path = os.path.abspath(data_path)
+    stat = os.stat(data_path)
+    key = "%s|%d|%d|%s|%s|%d" % (data_path, stat.st_size, stat.st_mtime_ns, format,
+                                 np.dtype(dtype).str, implicit_intercept)
+    if multiclass:
+        key += "|multiclass"
+    if disk_cache_dir is None:
+        disk_cache_dir = os.path.join(os.path.dirname(data_path), ".oracle_cache")
+    name = "%s-%s" % (os.path.basename(data_path), hashlib.md5(key.encode()).hexdigest()[:16])
+    return os.path.join(disk_cache_dir, name)
+
+def _save_disk_cache(path, X, y):
+    # пишем во временный каталог и переименовываем, чтобы не оставить
+    # недописанный кэш
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    if scipy.sparse.issparse(X):
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(tmp, name + ".npy"), getattr(X, name))
+        np.save(os.path.join(tmp, "shape.npy"), np.array(X.shape))
+    else:
+        np.save(os.path.join(tmp, "X.npy"), np.ascontiguousarray(X))
+    np.save(os.path.join(tmp, "y.npy"), y)
+    os.replace(tmp, path)
 
-def diff_grad(oracle, w):
+def _load_disk_cache(path):
+    load = lambda name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+    y = load("y")
+    if os.path.exists(os.path.join(path, "X.npy")):
+        return load("X"), y
+    shape = tuple(int(k) for k in load("shape"))
+    X = scipy.sparse.csr_matrix((load("data"), load("indices"), load("indptr")), shape=shape, copy=False)
+    return X, y
+
+# конечные разности сразу по блоку координат: оракул получает матрицу
+# W = w + eps * [e_i, ..., e_j] размера d x block_size и считает все
+# отступы одним умножением X на матрицу
+def _unit_block(w, start, stop, eps):
+    W = np.repeat(w.reshape(-1, 1), stop - start, axis=1)
+    W[np.arange(start, stop), np.arange(stop - start)] += eps
+    return W
+
+def diff_grad(oracle, w, block_size=256):
     f = oracle.value
     eps = 10**(-8)
-    n = oracle.X.shape[1]
+    n = oracle.dim
+    f0 = f(w)
     res = np.zeros(n)
-    for i in range(n):
-        e = np.zeros(n).reshape(-1, 1)
-        e[i] = [1.]
-        res[i] = (f(w + eps * e) - f(w)) / eps
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        res[start:stop] = ((f(_unit_block(w, start, stop, eps)) - f0) / eps).reshape(-1)
     return res.reshape(-1, 1)
 
-def diff_hessian(oracle, w):
+def diff_hessian(oracle, w, block_size=256):
     f = oracle.grad
     eps = 10**(-8)
-    n = oracle.X.shape[1]
-    res = [] 
-    for i in range(n):
-        e = np.zeros(n).reshape(-1, 1)
-        e[i] = [1.]
-        res.append(((f(w + eps * e) - f(w)) / eps).squeeze())
-    return np.array(res)
+    n = oracle.dim
+    g0 = f(w)
+    res = np.zeros((n, n))
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        res[start:stop] = ((f(_unit_block(w, start, stop, eps)) - g0) / eps).T
+    return res
 
-def hess_grad_test(oracle, n=5):
+# проверка по k случайным направлениям V: центральные разности
+# f(w +- eps V) и grad(w +- eps V) против g.T @ V и H @ V за один вызов
+# оракула на матрице d x 2k
+def directional_test(oracle, w, k=10, eps=1e-6):
+    V = np.random.randn(oracle.dim, k)
+    W = np.hstack([w + eps * V, w - eps * V])
+    values, grads = oracle.fuse_value_grad(W)
+    g = oracle.grad(w)
+    err_grad = (values[:, :k] - values[:, k:]) / (2 * eps) - g.T @ V
+    res = [np.max(np.abs(err_grad)), np.max(np.abs(err_grad)) / np.max(np.abs(g.T @ V))]
+    return res
+
+def hess_grad_test(oracle, n=5, block_size=256):
     max_err_grad = 0
+    max_rel_err_grad = 0
     max_err_hess = 0
+    max_rel_err_hess = 0
     for i in range(n):
-        w = np.random.rand(oracle.X.shape[1]).reshape(-1, 1)
+        w = np.random.rand(oracle.dim).reshape(-1, 1)
         true_grad = oracle.grad(w)
-        true_hessian = oracle.hessian(w)
-        grad = diff_grad(oracle, w)
-        hess = diff_hessian(oracle, w)
-        max_err_grad = max(max_err_grad, np.max(grad - true_grad))
-        max_err_hess = max(max_err_hess, np.max(hess - true_hessian))
+        grad = diff_grad(oracle, w, block_size)
+        max_err_grad = max(max_err_grad, np.max(np.abs(grad - true_grad)))
+        max_rel_err_grad = max(max_rel_err_grad, np.max(np.abs(grad - true_grad)) / np.max(np.abs(true_grad)))
+    # в этом оракуле гессиана нет, проверяется только градиент
     print("Максимальное значение ошибки приближения градиента: ", max_err_grad)
-    print("Максимальное значение ошибки приближения гессиана: ", max_err_hess)
\ No newline at end of file
+    print("Максимальная относительная ошибка приближения градиента: ", max_rel_err_grad)
+
+def directional_grad_test(oracle, n=5, k=10):
+    res = np.zeros(2)
+    for i in range(n):
+        w = np.random.rand(oracle.dim).reshape(-1, 1)
+        res = np.maximum(res, directional_test(oracle, w, k))
+    print("Максимальное значение ошибки градиента по направлениям: ", res[0])
+    print("Максимальная относительная ошибка градиента по направлениям: ", res[1])